@@ -1,9 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
+import collections
+import hashlib
+import inspect
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 from functools import update_wrapper, wraps
 
 
+PERSISTENT_MEMO_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'deco-memo.sqlite')
+PERSISTENT_MEMO_TIMEOUT = 30.0
+PERSISTENT_MEMO_SCHEMA = 1
+PICKLE_PROTOCOL = 4
+
+
 def disable(func):
     '''
     Disable a decorator by re-assigning the decorator's name
@@ -53,19 +71,359 @@ def countcalls(func):
     return wrapper
 
 
-def memo(func):
+class _Call:
+    '''Call in progress, other threads wait for its result.'''
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_KWARGS_MARK = object()
+
+
+def _make_key(args, kwargs):
+    '''Cache key of call arguments, positional only calls are keyed by args.'''
+    if not kwargs:
+        return args
+    return args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+
+
+def _lookup(wrapper, expires, key, ttl, timer):
+    '''Check that key is cached and not expired, mark it recently used.'''
+    if key not in wrapper.cache:
+        return False
+    if ttl is not None and expires[key] <= timer():
+        del wrapper.cache[key]
+        del expires[key]
+        wrapper.evictions.inc()
+        return False
+    wrapper.cache.move_to_end(key)
+    return True
+
+
+def _store(wrapper, expires, key, result, maxsize, ttl, timer):
     '''
-    Memoize a function so that it caches all return values for
-    faster future lookups.
+    Cache result, drop expired results from the least recently used end
+    and least recently used ones above maxsize. Purging stops at the first
+    live result, so only results used within last ttl seconds are kept.
+    '''
+    wrapper.cache[key] = result
+    wrapper.cache.move_to_end(key)
+    if ttl is not None:
+        now = timer()
+        expires[key] = now + ttl
+        while wrapper.cache and expires[next(iter(wrapper.cache))] <= now:
+            old_key, _ = wrapper.cache.popitem(last=False)
+            del expires[old_key]
+            wrapper.evictions.inc()
+    while maxsize is not None and len(wrapper.cache) > maxsize:
+        old_key, _ = wrapper.cache.popitem(last=False)
+        expires.pop(old_key, None)
+        wrapper.evictions.inc()
+
+
+def memo(func=None, maxsize=None, ttl=None, timer=time.monotonic):
+    '''
+    Memoize a function so that it caches return values for
+    faster future lookups. Used as @memo or with options:
+
+    @memo(maxsize=1024, ttl=60)
+    def fetch(url, timeout=10):
+        ....
+
+    At most maxsize least recently used results are kept, results older
+    than ttl seconds are dropped. Calls with unhashable arguments are
+    not cached. Threads calling with the same arguments at once wait for
+    the first one and share its result. wrapper.hits, wrapper.misses and
+    wrapper.evictions count lookups and dropped results.
     '''
+    if func is None:
+        return lambda func: memo(func, maxsize=maxsize, ttl=ttl, timer=timer)
+
+    lock = threading.Lock()
+    calls = {}
+    expires = {}
 
     @wraps(func)
-    def wrapper(*args):
-        if args not in wrapper.cache:
-            wrapper.cache[args] = func(*args)
-        return wrapper.cache[args]
+    def wrapper(*args, **kwargs):
+        key = _make_key(args, kwargs)
+        try:
+            hash(key)
+        except TypeError:
+            with lock:
+                wrapper.misses.inc()
+            return func(*args, **kwargs)
+
+        with lock:
+            if _lookup(wrapper, expires, key, ttl, timer):
+                wrapper.hits.inc()
+                return wrapper.cache[key]
+            call = calls.get(key)
+            if call is None:
+                call = calls[key] = _Call()
+                wrapper.misses.inc()
+                owner = True
+            elif call.thread == threading.get_ident():
+                # recursive call with the same arguments would wait for itself
+                wrapper.misses.inc()
+                call = None
+            else:
+                wrapper.hits.inc()
+                owner = False
+
+        if call is None:
+            return func(*args, **kwargs)
+        if not owner:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            with lock:
+                _store(wrapper, expires, key, call.result, maxsize, ttl, timer)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with lock:
+                del calls[key]
+            call.done.set()
+
+    wrapper.cache = collections.OrderedDict()
+    wrapper.hits = Counter()
+    wrapper.misses = Counter()
+    wrapper.evictions = Counter()
+    return wrapper
+
 
-    wrapper.cache = {}
+def async_countcalls(func):
+    '''Decorator that counts calls made to the coroutine function decorated.'''
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        wrapper.calls.inc()
+        return await func(*args, **kwargs)
+
+    wrapper.calls = Counter()
+    return wrapper
+
+
+def async_memo(func=None, maxsize=None, ttl=None, timer=time.monotonic):
+    '''
+    memo for coroutine functions: caches awaited results. Concurrent
+    awaiters of the same arguments share one task running the coroutine.
+    A cancelled awaiter does not cancel the task for the others, the task
+    is cancelled when all its awaiters are. Exceptions are raised to all
+    awaiters and are not cached.
+    '''
+    if func is None:
+        return lambda func: async_memo(func, maxsize=maxsize, ttl=ttl, timer=timer)
+
+    tasks = {}
+    waiters = collections.Counter()
+    expires = {}
+
+    async def run(key, args, kwargs):
+        try:
+            result = await func(*args, **kwargs)
+            _store(wrapper, expires, key, result, maxsize, ttl, timer)
+            return result
+        finally:
+            # task cancelled with its last awaiter is already removed
+            if tasks.get(key) is asyncio.current_task():
+                del tasks[key]
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = _make_key(args, kwargs)
+        try:
+            hash(key)
+        except TypeError:
+            wrapper.misses.inc()
+            return await func(*args, **kwargs)
+
+        if _lookup(wrapper, expires, key, ttl, timer):
+            wrapper.hits.inc()
+            return wrapper.cache[key]
+        task = tasks.get(key)
+        if task is None:
+            task = tasks[key] = asyncio.ensure_future(run(key, args, kwargs))
+            wrapper.misses.inc()
+        elif task is asyncio.current_task():
+            # recursive call with the same arguments would wait for itself
+            wrapper.misses.inc()
+            return await func(*args, **kwargs)
+        else:
+            wrapper.hits.inc()
+
+        waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if waiters[task] == 1 and not task.done():
+                # next call starts a new task instead of joining the cancelled one
+                if tasks.get(key) is task:
+                    del tasks[key]
+                task.cancel()
+            raise
+        finally:
+            waiters[task] -= 1
+            if not waiters[task]:
+                del waiters[task]
+
+    wrapper.cache = collections.OrderedDict()
+    wrapper.hits = Counter()
+    wrapper.misses = Counter()
+    wrapper.evictions = Counter()
+    return wrapper
+
+
+def _func_version(func):
+    '''Hash of function source, of its bytecode if source is not available.'''
+    try:
+        source = inspect.getsource(func).encode()
+    except (OSError, TypeError):
+        source = func.__code__.co_code
+    return hashlib.sha256(source).hexdigest()
+
+
+def _encode_key(value):
+    '''
+    Encode value to bytes that don't depend on process: elements of sets
+    and dicts are sorted by their encoding, because their order depends
+    on hash randomization. Values of other types are pickled.
+    '''
+    if value is None or isinstance(value, (bool, int, float, complex)):
+        data = repr(value).encode()
+    elif isinstance(value, str):
+        data = value.encode('utf-8', 'surrogatepass')
+    elif isinstance(value, (bytes, bytearray)):
+        data = bytes(value)
+    elif isinstance(value, (tuple, list)):
+        data = b''.join(_encode_key(item) for item in value)
+    elif isinstance(value, dict):
+        data = b''.join(sorted(_encode_key(k) + _encode_key(v) for k, v in value.items()))
+    elif isinstance(value, (set, frozenset)):
+        data = b''.join(sorted(_encode_key(item) for item in value))
+    else:
+        data = pickle.dumps(value, protocol=PICKLE_PROTOCOL)
+    tag = '{}.{}'.format(type(value).__module__, type(value).__qualname__).encode()
+    return b'%s:%d:%s' % (tag, len(data), data)
+
+
+def _persistent_key(name, version, args, kwargs):
+    '''Key of call in persistent_memo database, the same in every process.'''
+    return hashlib.sha256(_encode_key((name, version, args, kwargs))).hexdigest()
+
+
+def _connect(path, timeout):
+    connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    with connection:
+        connection.execute('BEGIN IMMEDIATE')
+        # results of every function are counted apart for maxsize, table
+        # of version 0 without function names is dropped
+        if connection.execute('PRAGMA user_version').fetchone()[0] < PERSISTENT_MEMO_SCHEMA:
+            connection.execute('DROP TABLE IF EXISTS memo')
+            connection.execute('PRAGMA user_version = {:d}'.format(PERSISTENT_MEMO_SCHEMA))
+        connection.execute('''CREATE TABLE IF NOT EXISTS memo (
+            key TEXT PRIMARY KEY, name TEXT NOT NULL, value BLOB NOT NULL, used REAL NOT NULL)''')
+        connection.execute('CREATE INDEX IF NOT EXISTS memo_name_used ON memo (name, used)')
+    return connection
+
+
+def persistent_memo(func=None, path=PERSISTENT_MEMO_PATH, maxsize=None, version=None,
+                    timeout=PERSISTENT_MEMO_TIMEOUT):
+    '''
+    Memoize a function in sqlite database at path shared by processes, so
+    results survive restarts. Used as @persistent_memo or with options:
+
+    @persistent_memo(path='/var/cache/app/memo.sqlite', maxsize=10000, version='2')
+    def report(date):
+        ....
+
+    Calls are keyed by sha256 of function name, version and arguments
+    encoded the same way in every process: elements of sets and dicts are
+    sorted, values of types other than builtin ones are pickled. By default
+    version is hash of function source, so results of changed function are
+    not used. At most maxsize least recently used results of the function,
+    of all its versions, are kept in database, other functions sharing the
+    database have their own limits. Calls with arguments or results that
+    can't be pickled are not cached, results that can't be unpickled any
+    more are computed again.
+    Database is in WAL mode, processes wait for locks for timeout seconds.
+    '''
+    if func is None:
+        return lambda func: persistent_memo(func, path=path, maxsize=maxsize, version=version, timeout=timeout)
+
+    name = '{}.{}'.format(func.__module__, func.__qualname__)
+    func_version = _func_version(func) if version is None else str(version)
+    # connection per thread, a forked process opens its own
+    local = threading.local()
+    lock = threading.Lock()
+
+    def get_connection():
+        if getattr(local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            local.connection = _connect(path, timeout)
+            local.pid = os.getpid()
+        return local.connection
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            key = _persistent_key(name, func_version, args, kwargs)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            wrapper.misses.inc()
+            return func(*args, **kwargs)
+
+        connection = get_connection()
+        row = connection.execute('SELECT value FROM memo WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            try:
+                result = pickle.loads(row[0])
+            except Exception:
+                # class of result was renamed or moved, compute it again
+                connection.execute('DELETE FROM memo WHERE key = ?', (key,))
+            else:
+                with lock:
+                    wrapper.hits.inc()
+                connection.execute('UPDATE memo SET used = ? WHERE key = ?', (time.time(), key))
+                return result
+        with lock:
+            wrapper.misses.inc()
+
+        result = func(*args, **kwargs)
+        try:
+            value = pickle.dumps(result, protocol=PICKLE_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return result
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('INSERT OR REPLACE INTO memo (key, name, value, used) VALUES (?, ?, ?, ?)',
+                               (key, name, value, time.time()))
+            if maxsize is not None:
+                evicted = connection.execute(
+                    '''DELETE FROM memo WHERE key IN (
+                        SELECT key FROM memo WHERE name = ? ORDER BY used DESC LIMIT -1 OFFSET ?)''',
+                    (name, maxsize)).rowcount
+                with lock:
+                    wrapper.evictions.counter += evicted
+        return result
+
+    wrapper.cache_path = path
+    wrapper.hits = Counter()
+    wrapper.misses = Counter()
+    wrapper.evictions = Counter()
     return wrapper
 
 
@@ -148,6 +506,23 @@ def fib(n):
     return 1 if n <= 1 else fib(n - 1) + fib(n - 2)
 
 
+@countcalls
+@memo(maxsize=2)
+def square(x):
+    return x * x
+
+
+@async_countcalls
+@async_memo(maxsize=16)
+async def fetch(key):
+    await asyncio.sleep(0.01)
+    return key.upper()
+
+
+async def fetch_all():
+    return await asyncio.gather(*[fetch(key) for key in ['a', 'b', 'a', 'a', 'b']])
+
+
 def main():
     print(foo(4, 3))
     print(foo(4, 3, 2))
@@ -163,6 +538,217 @@ def main():
     fib(3)
     print(fib.calls, 'calls made')
 
+    for x in [2, 3, 2, 4, 3]:
+        print(square(x))
+    print("square cache: hits", square.hits, "misses", square.misses, "evictions", square.evictions)
+
+    print(asyncio.run(fetch_all()))
+    print("fetch was called", fetch.calls, "times, cache misses", fetch.misses)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cube = persistent_memo(lambda x: x ** 3, path=os.path.join(cache_dir, 'memo.sqlite'), version=1)
+        print(cube(3), cube(3))
+        print("cube cache: hits", cube.hits, "misses", cube.misses)
+
+
+def test_memo():
+    print("test_memo...")
+    now = [0.0]
+
+    @memo(maxsize=2, ttl=10, timer=lambda: now[0])
+    def double(x, factor=2):
+        return x * factor
+
+    assert (double(1) == 2 and double(1, factor=3) == 3 and double(1) == 2)
+    assert (list(double.cache) == [(1, _KWARGS_MARK, ('factor', 3)), (1,)])
+    # (1,) was used last, so (1, factor=3) is evicted
+    double(2)
+    assert (list(double.cache) == [(1,), (2,)] and double.evictions.counter == 1)
+    now[0] = 5
+    double(3)
+    assert (list(double.cache) == [(2,), (3,)])
+    # (2,) expired and is purged on the next store without being requested again
+    now[0] = 12
+    double(4)
+    assert (list(double.cache) == [(3,), (4,)])
+    now[0] = 16
+    double(5)
+    assert (list(double.cache) == [(4,), (5,)])
+    assert (double([1]) == [1, 1] and len(double.cache) == 2)
+    assert ((double.hits.counter, double.misses.counter, double.evictions.counter) == (1, 7, 4))
+
+    @memo(ttl=1, timer=lambda: now[0])
+    def ident(x):
+        return x
+
+    for x in range(0, 100):
+        now[0] += 0.5
+        ident(x)
+    # without maxsize only results of the last second are kept
+    assert (len(ident.cache) == 2)
+    print('OK')
+
+
+def test_memo_recursive():
+    print("test_memo_recursive...")
+    calls = []
+
+    @memo
+    def again(x):
+        calls.append(x)
+        # call with the same arguments from the function itself runs uncached
+        return again(x) + 1 if len(calls) == 1 else x
+
+    assert (again(1) == 2 and again(1) == 2)
+    assert (calls == [1, 1] and again.misses.counter == 2 and again.hits.counter == 1)
+    print('OK')
+
+
+def test_memo_threads():
+    print("test_memo_threads...")
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    @memo
+    def slow(x):
+        calls.append(x)
+        started.set()
+        release.wait()
+        if x < 0:
+            raise ValueError(x)
+        return x
+
+    for x in [1, -1]:
+        results = []
+
+        def call():
+            try:
+                results.append(slow(x))
+            except ValueError as e:
+                results.append(e)
+
+        started.clear()
+        release.clear()
+        threads = [threading.Thread(target=call) for _ in range(0, 4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        # other threads wait for the result of the first one
+        while slow.hits.counter < 3 * len(calls):
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert (len(results) == 4 and len(set(map(repr, results))) == 1), results
+    assert (calls == [1, -1] and list(slow.cache) == [(1,)])
+    print('OK')
+
+
+def test_async_memo():
+    print("test_async_memo...")
+    calls = []
+
+    @async_memo(maxsize=4)
+    async def slow(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        if x < 0:
+            raise ValueError(x)
+        return x
+
+    async def run():
+        # concurrent calls await one task
+        assert (await asyncio.gather(slow(1), slow(1), slow(1)) == [1, 1, 1])
+        assert (calls == [1] and slow.misses.counter == 1 and slow.hits.counter == 2)
+        results = await asyncio.gather(slow(-1), slow(-1), return_exceptions=True)
+        assert (all(isinstance(r, ValueError) for r in results) and calls == [1, -1])
+        assert (list(slow.cache) == [(1,)])
+
+        # cancelling one awaiter does not cancel the task for the others
+        first = asyncio.ensure_future(slow(2))
+        second = asyncio.ensure_future(slow(2))
+        while calls[-1] != 2:
+            await asyncio.sleep(0)
+        first.cancel()
+        assert (await second == 2 and first.cancelled() and calls == [1, -1, 2])
+
+        # task is cancelled with its last awaiter, next call starts a new one
+        task = asyncio.ensure_future(slow(3))
+        while calls[-1] != 3:
+            await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.sleep(0)
+        assert (await slow(3) == 3 and task.cancelled() and calls == [1, -1, 2, 3, 3])
+        await asyncio.sleep(0.02)
+        assert (list(slow.cache) == [(1,), (2,), (3,)])
+
+    asyncio.run(run())
+    print('OK')
+
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+
+def test_persistent_memo():
+    print("test_persistent_memo...")
+    args = ({'alpha', 'beta', 'gamma', 'delta'}, {'x': frozenset([1, 2]), 'y': [1.5, None]})
+    key = _persistent_key('f', '1', args, {'k': 'v'})
+    # the same key in processes with other hash seeds
+    code = 'import deco; print(deco._persistent_key("f", "1", {!r}, {{"k": "v"}}))'.format(args)
+    for seed in ['1', '2', '3']:
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ, PYTHONHASHSEED=seed))
+        assert (output.decode().strip() == key), seed
+    assert (_persistent_key('f', '1', (1,), {}) != _persistent_key('f', '1', (1.0,), {}))
+    assert (_persistent_key('f', '1', ((1,),), {}) != _persistent_key('f', '1', ([1],), {}))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        path = os.path.join(cache_dir, 'memo.sqlite')
+        calls = []
+
+        @persistent_memo(path=path, maxsize=2, version=1)
+        def wrap(x):
+            calls.append(x)
+            return _Result(x)
+
+        assert (wrap(1).value == 1 and wrap(1).value == 1 and wrap(2).value == 2 and wrap(3).value == 3)
+        assert (calls == [1, 2, 3] and wrap.hits.counter == 1 and wrap.evictions.counter == 1)
+        # a result whose class is not importable any more is computed again
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute('UPDATE memo SET value = ?', (pickle.dumps(_Result(0)).replace(b'_Result', b'_Resulx'),))
+        connection.close()
+        assert (wrap(3).value == 3 and wrap(3).value == 3 and calls == [1, 2, 3, 3])
+
+        # maxsize of one function does not evict results of another one
+        @persistent_memo(path=path)
+        def square(x):
+            calls.append(x * x)
+            return x * x
+
+        for x in range(0, 10):
+            square(x)
+        for x in range(10, 15):
+            wrap(x)
+        for x in range(0, 10):
+            square(x)
+        assert (square.hits.counter == 10 and square.misses.counter == 10)
+        connection = sqlite3.connect(path)
+        counts = connection.execute('SELECT name, COUNT(*) FROM memo GROUP BY name').fetchall()
+        assert (sorted((name.rsplit('.', 1)[1], count) for name, count in counts) == [('square', 10), ('wrap', 2)])
+        connection.close()
+    print('OK')
+
 
 if __name__ == '__main__':
     main()
+    test_memo()
+    test_memo_recursive()
+    test_memo_threads()
+    test_async_memo()
+    test_persistent_memo()
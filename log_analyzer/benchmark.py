@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import gzip
+import json
+import pathlib
+import platform
+import random
+import tempfile
+import time
+
+import log_analyzer
+
+DEFAULT_LOG_PATH = './test/log/nginx-access-ui.log-20170630.gz'
+DEFAULT_CONFIG_PATH = './test/config.json'
+
+URL_TEMPLATES = [
+    '/api/v2/banner/{id}',
+    '/api/v2/banner/{id}/statistic/?date_from={date}&date_to={date}',
+    '/api/1/photogenic_banners/list/?server_name=WIN7RB{small_id}',
+    '/api/v2/group/{id}/banners',
+    '/api/v2/slot/{id}/groups',
+    '/export/appinstall_raw/{date}/',
+    '/api/v2/internal/html5/phantomjs/queue/?wait=1m',
+]
+USER_AGENTS = [
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+    'python-requests/2.13.0',
+    '-',
+]
+BROKEN_LINE = '{ip} -  - [{time_local}] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n'
+LOG_LINE = (
+    '{ip} -  - [{time_local}] "{method} {url} HTTP/1.1" {status} {size} "-" '
+    '"{user_agent}" "-" "{request_id}" "dc7161be3" {request_time:.3f}\n'
+)
+
+
+def read_lines(log_path):
+    log_path = pathlib.Path(log_path)
+    open_func = gzip.open if log_path.suffix == '.gz' else open
+    with open_func(str(log_path), 'rb') as log_file:
+        return log_file.read().splitlines()
+
+
+def bench_parse_line(lines, min_lines):
+    repeat = max(1, min_lines // max(1, len(lines)))
+    # regex parser works with decoded lines with line ends, fast one with raw bytes
+    text_lines = [line.decode() + '\n' for line in lines]
+    results = {}
+    for name, parse_func, parsed_lines in (
+            ('regex', log_analyzer.parse_line_regex, text_lines),
+            ('fast', log_analyzer.parse_line, lines)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for line in parsed_lines:
+                parse_func(line)
+        elapsed = time.perf_counter() - start
+        results[name] = len(parsed_lines) * repeat / elapsed
+    return results
+
+
+def generate_lines(line_count, url_count, error_rate, date, seed):
+    """
+    Lines of ui_short log: urls have zipf-like popularity and request times
+    have lognormal distribution with median depending on url
+    """
+    rnd = random.Random(seed)
+    urls = [
+        URL_TEMPLATES[n % len(URL_TEMPLATES)].format(
+            id=rnd.randint(1, 99999999), small_id=n, date=date.strftime('%Y-%m-%d'))
+        for n in range(url_count)
+    ]
+    url_cum_weights = []
+    weight_sum = 0.0
+    for n in range(url_count):
+        weight_sum += 1.0 / (n + 1)
+        url_cum_weights.append(weight_sum)
+    url_medians = [0.05 * (1 + n % 50) for n in range(url_count)]
+    ips = ['1.{:d}.{:d}.{:d}'.format(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254)) for _ in range(1000)]
+    start_time = date.replace(hour=3, minute=0, second=0)
+    batch_size = 10000
+
+    for batch_start in range(0, line_count, batch_size):
+        url_indexes = rnd.choices(range(url_count), cum_weights=url_cum_weights,
+                                  k=min(batch_size, line_count - batch_start))
+        time_local = (start_time + datetime.timedelta(seconds=batch_start * 86400 // line_count)).strftime(
+            '%d/%b/%Y:%H:%M:%S +0300')
+        for n, url_index in enumerate(url_indexes, batch_start):
+            ip = rnd.choice(ips)
+            if rnd.random() < error_rate:
+                yield BROKEN_LINE.format(ip=ip, time_local=time_local)
+                continue
+            yield LOG_LINE.format(
+                ip=ip,
+                time_local=time_local,
+                method='GET' if rnd.random() < 0.9 else 'POST',
+                url=urls[url_index],
+                status=200,
+                size=rnd.randint(100, 100000),
+                user_agent=rnd.choice(USER_AGENTS),
+                request_id='{:d}-{:d}-4708-{:d}'.format(1498697457 + n, rnd.randint(0, 4294967295), n),
+                request_time=rnd.lognormvariate(0.0, 1.0) * url_medians[url_index])
+
+
+def generate_log(log_dir, line_count, url_count, error_rate, date, is_gz, seed):
+    log_dir_path = pathlib.Path(log_dir)
+    log_dir_path.mkdir(parents=True, exist_ok=True)
+    log_file_name = 'nginx-access-ui.log-' + date.strftime('%Y%m%d') + ('.gz' if is_gz else '')
+    log_file_path = log_dir_path / log_file_name
+    open_func = gzip.open if is_gz else open
+    with open_func(str(log_file_path), 'wt') as log_file:
+        log_file.writelines(generate_lines(line_count, url_count, error_rate, date, seed))
+    return log_file_path
+
+
+def run_stage(results, name, func, count_func=None):
+    """
+    Time stage and measure memory: peak RSS only grows, so growth of peak
+    RSS of process during stage is reported besides peak RSS itself.
+    Growth is 0 if stage did not need more memory than earlier stages.
+    """
+    start_rss, _ = log_analyzer.get_peak_rss()
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    result = func()
+    wall_time = time.perf_counter() - start
+    peak_rss, children_peak_rss = log_analyzer.get_peak_rss()
+    results[name] = {
+        'wall_time': wall_time,
+        'cpu_time': time.process_time() - start_cpu,
+        'peak_rss': peak_rss,
+        'peak_rss_growth': peak_rss - start_rss,
+        'children_peak_rss': children_peak_rss
+    }
+    if count_func is not None:
+        results[name]['count'] = count_func(result)
+        results[name]['count_per_sec'] = results[name]['count'] / wall_time if wall_time > 0 else None
+    return result
+
+
+def bench_stages(config):
+    """
+    Time every stage of log_analyzer pipeline separately. Records are
+    never kept in memory: parse_log stage only counts parsed records,
+    process_log stage parses log again and collects statistic as script
+    does, so collecting takes the difference of their times
+    """
+    stages = {}
+
+    log_info = run_stage(stages, 'find_last_log', lambda: log_analyzer.find_last_log(config))
+    if log_info is None:
+        raise Exception('No log found in {}'.format(config.LOG_DIR))
+    run_stage(stages, 'parse_log', lambda: sum(1 for _ in log_analyzer.parse_log(config, log_info)),
+              lambda record_count: record_count)
+    urls_info = run_stage(stages, 'process_log', lambda: log_analyzer.process_log(config, log_info),
+                          lambda urls_info: urls_info.count)
+    report_info = run_stage(stages, 'make_report_info', lambda: log_analyzer.make_report_info(config, urls_info),
+                            lambda _: len(urls_info.info))
+    report_file_path = pathlib.Path(config.REPORT_DIR) / 'benchmark-report.html'
+    run_stage(stages, 'render_report', lambda: log_analyzer.render_report(config, report_file_path, report_info),
+              lambda _: len(report_info))
+
+    log_file_size = log_info.file_path.stat().st_size
+    stages['parse_log']['bytes_per_sec'] = log_file_size / stages['parse_log']['wall_time']
+    stages['process_log']['bytes_per_sec'] = log_file_size / stages['process_log']['wall_time']
+
+    return {
+        'log_file_path': str(log_info.file_path),
+        'log_file_size': log_file_size,
+        'record_count': urls_info.count,
+        'url_count': len(urls_info.info),
+        'stages': stages
+    }
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description="log_analyzer benchmarks")
+    sub_parsers = args_parser.add_subparsers(dest='command')
+    sub_parsers.required = True
+
+    parse_parser = sub_parsers.add_parser('parse', help="compare lines/sec of regex and fast line parsers")
+    parse_parser.add_argument("--log", help="log file to take lines from", type=str, default=DEFAULT_LOG_PATH)
+    parse_parser.add_argument("--lines", help="minimal number of lines to parse", type=int, default=1000000)
+
+    generate_parser = sub_parsers.add_parser('generate', help="generate synthetic log in ui_short format")
+    generate_parser.add_argument("--log-dir", help="directory to write log to", type=str, required=True)
+    generate_parser.add_argument("--lines", help="number of lines in log", type=int, default=1000000)
+    generate_parser.add_argument("--urls", help="number of distinct urls", type=int, default=10000)
+    generate_parser.add_argument("--error-rate", help="share of broken lines", type=float, default=0.001)
+    generate_parser.add_argument("--date", help="date of log YYYYMMDD", type=log_analyzer.parse_date,
+                                 default=datetime.datetime(2017, 6, 30))
+    generate_parser.add_argument("--gzip", help="compress log with gzip", action='store_true')
+    generate_parser.add_argument("--seed", help="random seed", type=int, default=0)
+
+    stages_parser = sub_parsers.add_parser('stages', help="time every stage for the last log in directory")
+    stages_parser.add_argument("--log-dir", help="directory with logs", type=str, required=True)
+    stages_parser.add_argument("--config", help="config to take settings from", type=str, default=DEFAULT_CONFIG_PATH)
+    stages_parser.add_argument("--set", help="override config setting with json value", nargs=2, action='append',
+                               metavar=('KEY', 'VALUE'), default=[])
+    stages_parser.add_argument("--output", help="json file to write results to", type=str)
+
+    args = args_parser.parse_args()
+
+    if args.command == 'parse':
+        lines = read_lines(args.log)
+        for name, lines_per_sec in bench_parse_line(lines, args.lines).items():
+            print('{:s}: {:.0f} lines/sec'.format(name, lines_per_sec))
+
+    elif args.command == 'generate':
+        print(generate_log(args.log_dir, args.lines, args.urls, args.error_rate, args.date, args.gzip, args.seed))
+
+    elif args.command == 'stages':
+        settings = {key: json.loads(value) for key, value in args.set}
+        config = log_analyzer.Config(args.config)
+        with tempfile.TemporaryDirectory() as report_dir:
+            config.config.update(LOG_DIR=args.log_dir, REPORT_DIR=report_dir, AGGREGATE_CACHE=False)
+            config.config.update(settings)
+            results = bench_stages(config)
+        results.update({
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': settings
+        })
+        results_json = json.dumps(results, indent=4, sort_keys=True)
+        if args.output is not None:
+            pathlib.Path(args.output).write_text(results_json)
+        print(results_json)
+
+
+if __name__ == "__main__":
+    main()
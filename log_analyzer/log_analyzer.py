@@ -7,6 +7,7 @@
 #                     '$request_time';
 
 import argparse
+import array
 import json
 import logging
 import os
@@ -23,24 +24,82 @@ import collections
 import datetime
 from string import Template
 import functools
+import sys
+import io
+import itertools
+import math
+import multiprocessing
+import mmap
+import shlex
+import zlib
+import pickle
+import copy
+import heapq
+import contextlib
+import resource
+import statistics
+import bisect
 
 DEFAULT_CONFIG = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
     "REPORT_TEMPLATE": "./report.html",
     "LOG_DIR": "./log",
+    "LOG_INDEX_PATH": None,
     "PARSE_ERROR_RATE": 0.01,
+    "PARSE_ERROR_WARMUP": 10000,
+    "PARSE_ERROR_CONFIDENCE": 0.999,
+    "PARSE_ERROR_SAMPLES": 10,
+    "PARSE_WORKERS": 1,
+    "PARSE_CHUNK_SIZE": 64 * 1024 * 1024,
+    "PARSE_BATCH_LINES": 100000,
+    "GZIP_COMMAND": None,
+    "AGGREGATION": "exact",
+    "SKETCH_RELATIVE_ERROR": 0.01,
+    "SKETCH_MAX_BUCKETS": 1024,
+    "AGGREGATE_CACHE": False,
+    "URL_DROP_QUERY": False,
+    "URL_COLLAPSE_IDS": False,
+    "URL_REWRITE_RULES": [],
+    "URL_MAX_COUNT": None,
+    "FOLLOW_LOG_PATH": None,
+    "FOLLOW_INTERVAL": 60,
+    "FOLLOW_LINES": 1000000,
+    "PROGRESS_INTERVAL": 60,
+    "METRICS_PATH": None,
+    "METRICS_FORMAT": "json",
     "SCRIPT_LOG_PATH": None
 }
 DEFAULT_CONFIG_JSON_PATH = './config.json'
 
 # LOG_PARSE_PATTERN = re.compile('.+"(?:GET|HEAD|POST|PUT|DELETE|CONNECT|OPTIONS|TRACE|PATCH)\\s([^\\s]+)\\s.+\\s([\\d\\.]+)\\n')
+LOG_NAME_PREFIX = 'nginx-access-ui.log-'
 LOG_NAME_PATTERN = re.compile('nginx-access-ui.log-(\\d{8})(\\.gz)?')
 LOG_PARSE_PATTERN = re.compile('.+?\\]\\s"[^\\s"]+\\s([^\\s"]+)\\s.+\\s([\\d\\.]+)\\n')
+NUMERIC_SEGMENT_PATTERN = re.compile('/\\d+(?=/|$)')
+UUID_SEGMENT_PATTERN = re.compile('/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)')
+READ_CHUNK_SIZE = 1024 * 1024
+ERROR_LINE_MAX_SIZE = 1024
+URL_NORMALIZE_CACHE_SIZE = 64 * 1024
+OTHER_URL = '__other__'
+FOLLOW_LOG_NAME = 'nginx-access-ui.log'
+FOLLOW_POLL_INTERVAL = 1.0
+METRICS_FORMAT_JSON = 'json'
+METRICS_FORMAT_PROMETHEUS = 'prometheus'
+METRICS_PREFIX = 'log_analyzer_'
+AGGREGATE_VERSION = 1
+LOG_INDEX_VERSION = 1
+TEMPLATE_CACHE_SIZE = 4
+TABLE_JSON = object()
+LOG_INDEX_RACY_INTERVAL = 2
 
 LogInfo = collections.namedtuple('LogInfo', 'file_path date is_gz')
 LogRecord = collections.namedtuple('LogRecord', 'url process_time')
 UrlsInfo = collections.namedtuple('UrlsInfo', 'info count time_sum')
+LogPart = collections.namedtuple('LogPart', 'log_info start end lines')
+
+AGGREGATION_EXACT = 'exact'
+AGGREGATION_SKETCH = 'sketch'
 
 
 class Config:
@@ -61,16 +120,314 @@ class Config:
         self.config = config
 
     def __getattr__(self, key):
-        if key in self.config:
-            return self.config[key]
+        # look into __dict__ directly, so unpickled instance in worker process
+        # does not recurse before config attribute is restored
+        config = self.__dict__.get('config', {})
+        if key in config:
+            return config[key]
+        else:
+            raise AttributeError(key)
+
+
+class ParseStat:
+    """
+    Counters of parsed lines, errors, bytes of log file and of decompressed
+    data. Progress callback is called with this object as data is read.
+    Random sample of unparsed lines is kept for diagnosis, error monitor
+    checks error rate as soon as error is counted.
+    """
+
+    def __init__(self, line_count=0, error_count=0, progress=None, error_monitor=None, error_sample_size=0):
+        self.line_count = line_count
+        self.error_count = error_count
+        self.file_size = 0
+        self.data_size = 0
+        self.error_lines = []
+        self.error_sample_size = error_sample_size
+        self.progress = progress
+        self.error_monitor = error_monitor
+
+    def add_error(self, line):
+        self.error_count += 1
+        # reservoir sampling: every unparsed line has the same chance to be kept
+        if len(self.error_lines) < self.error_sample_size:
+            self.error_lines.append(line[:ERROR_LINE_MAX_SIZE])
         else:
-            raise AttributeError
+            index = random.randrange(self.error_count)
+            if index < self.error_sample_size:
+                self.error_lines[index] = line[:ERROR_LINE_MAX_SIZE]
+        self.check_error_rate()
+
+    def update(self, parse_stat):
+        self.line_count += parse_stat.line_count
+        self.error_count += parse_stat.error_count
+        self.file_size += parse_stat.file_size
+        self.data_size += parse_stat.data_size
+        error_lines = self.error_lines + parse_stat.error_lines
+        if len(error_lines) > self.error_sample_size:
+            error_lines = random.sample(error_lines, self.error_sample_size)
+        self.error_lines = error_lines
+        self.report_progress()
+        self.check_error_rate()
+
+    def report_progress(self):
+        if self.progress is not None:
+            self.progress(self)
+
+    def check_error_rate(self):
+        if self.error_monitor is not None:
+            self.error_monitor.check(self)
+
+    def __getstate__(self):
+        # callbacks stay in process where they were set
+        state = self.__dict__.copy()
+        state['progress'] = None
+        state['error_monitor'] = None
+        return state
+
+
+class ErrorRateMonitor:
+    """
+    Aborts parsing as soon as error rate is surely greater than PARSE_ERROR_RATE:
+    after PARSE_ERROR_WARMUP lines lower bound of Wilson score interval
+    with PARSE_ERROR_CONFIDENCE level is compared with PARSE_ERROR_RATE
+    """
+
+    def __init__(self, config):
+        self.max_rate = config.PARSE_ERROR_RATE
+        self.warmup = config.PARSE_ERROR_WARMUP
+        self.z = statistics.NormalDist().inv_cdf(config.PARSE_ERROR_CONFIDENCE)
+
+    def get_lower_bound(self, line_count, error_count):
+        rate = error_count / line_count
+        z2 = self.z * self.z
+        center = rate + z2 / (2 * line_count)
+        margin = self.z * math.sqrt(rate * (1 - rate) / line_count + z2 / (4 * line_count * line_count))
+        return (center - margin) / (1 + z2 / line_count)
+
+    def is_exceeded(self, parse_stat):
+        if parse_stat.line_count < self.warmup:
+            return False
+        return self.get_lower_bound(parse_stat.line_count, parse_stat.error_count) > self.max_rate
+
+    def check(self, parse_stat):
+        if self.is_exceeded(parse_stat):
+            log_error_lines(parse_stat)
+            raise Exception('Too many unparsed lines: {:d} errors in first {:d} lines'.format(
+                parse_stat.error_count, parse_stat.line_count))
+
+
+def make_parse_stat(config, progress=None):
+    return ParseStat(progress=progress, error_monitor=ErrorRateMonitor(config),
+                     error_sample_size=config.PARSE_ERROR_SAMPLES)
+
+
+def get_peak_rss():
+    """Peak resident set size in bytes of this process and of the biggest child process"""
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+class Metrics:
+    """Time and throughput of stages of script, saved to METRICS_PATH for monitoring"""
+
+    def __init__(self, config):
+        self.config = config
+        self.start_time = time.time()
+        self.start_monotonic = time.monotonic()
+        self.progress_time = self.start_monotonic
+        self.stages = collections.OrderedDict()
+        self.parse_stat = ParseStat(progress=self.progress)
+        self.url_count = None
+        self.success = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        start_times = os.times()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start
+            times = os.times()
+            # cpu time of child processes is counted when they are finished
+            cpu_time = sum(times[:4]) - sum(start_times[:4])
+            self.stages[name] = {'wall_time': wall_time, 'cpu_time': cpu_time}
+            logging.info('Stage %s finished: %.3f s wall, %.3f s cpu', name, wall_time, cpu_time)
+
+    def progress(self, parse_stat):
+        now = time.monotonic()
+        if now - self.progress_time < self.config.PROGRESS_INTERVAL:
+            return
+        self.progress_time = now
+        elapsed = now - self.start_monotonic
+        line_count, error_count, data_size = parse_stat.line_count, parse_stat.error_count, parse_stat.data_size
+        if parse_stat is not self.parse_stat:
+            # counters of current log are added to total only when log is finished,
+            # so rate since start of script is reported for logs processed so far
+            line_count += self.parse_stat.line_count
+            error_count += self.parse_stat.error_count
+            data_size += self.parse_stat.data_size
+        logging.info(
+            'Progress: %d lines with %d errors, %.1f MB of data, %.0f lines/sec, %.1f MB/sec',
+            line_count, error_count, data_size / 1e6, line_count / elapsed, data_size / 1e6 / elapsed)
+
+    def make_metrics(self):
+        peak_rss, children_peak_rss = get_peak_rss()
+        metrics = {
+            'start_time': self.start_time,
+            'duration': time.monotonic() - self.start_monotonic,
+            'success': self.success,
+            'line_count': self.parse_stat.line_count,
+            'error_count': self.parse_stat.error_count,
+            'file_bytes': self.parse_stat.file_size,
+            'data_bytes': self.parse_stat.data_size,
+            'url_count': self.url_count,
+            'peak_rss_bytes': peak_rss,
+            'children_peak_rss_bytes': children_peak_rss,
+            'stages': self.stages
+        }
+        collect_stage = self.stages.get('collect')
+        if collect_stage is not None and collect_stage['wall_time'] > 0 and self.parse_stat.line_count > 0:
+            metrics['lines_per_sec'] = self.parse_stat.line_count / collect_stage['wall_time']
+            metrics['file_bytes_per_sec'] = self.parse_stat.file_size / collect_stage['wall_time']
+            metrics['data_bytes_per_sec'] = self.parse_stat.data_size / collect_stage['wall_time']
+        return metrics
+
+    def format_prometheus(self, metrics):
+        lines = []
+        for key, value in sorted(metrics.items()):
+            if key == 'stages' or value is None:
+                continue
+            lines.append('{}{} {}'.format(METRICS_PREFIX, key, float(value)))
+        for name, stage in metrics['stages'].items():
+            for key, value in sorted(stage.items()):
+                lines.append('{}stage_{}{{stage="{}"}} {}'.format(METRICS_PREFIX, key, name, float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def save(self):
+        if self.config.METRICS_PATH is None:
+            return
+
+        metrics = self.make_metrics()
+        if self.config.METRICS_FORMAT == METRICS_FORMAT_PROMETHEUS:
+            metrics_text = self.format_prometheus(metrics)
+        elif self.config.METRICS_FORMAT == METRICS_FORMAT_JSON:
+            metrics_text = json.dumps(metrics, indent=4)
+        else:
+            raise Exception('Unknown metrics format: {}'.format(self.config.METRICS_FORMAT))
+
+        metrics_file_path = pathlib.Path(self.config.METRICS_PATH)
+        tmp_metrics_file_path = metrics_file_path.with_suffix(metrics_file_path.suffix + '.tmp')
+        try:
+            tmp_metrics_file_path.write_text(metrics_text)
+            tmp_metrics_file_path.rename(metrics_file_path)
+        finally:
+            if tmp_metrics_file_path.is_file():
+                tmp_metrics_file_path.unlink()
+
+
+class UrlSketch:
+    """
+    Fixed size summary of url process times: count, sum, max and histogram
+    with logarithmic buckets. Any quantile is estimated with relative error
+    not greater than relative_error until histogram has no more than
+    max_buckets buckets, after that lowest buckets are collapsed.
+    Sketches are merged by adding bucket counts.
+    """
+
+    __slots__ = ('count', 'time_sum', 'time_max', 'zero_count', 'buckets', 'gamma', 'log_gamma', 'max_buckets')
+
+    def __init__(self, relative_error, max_buckets):
+        self.count = 0
+        self.time_sum = 0.0
+        self.time_max = None
+        self.zero_count = 0
+        self.buckets = {}
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+
+    def add(self, process_time):
+        self.count += 1
+        self.time_sum += process_time
+        if self.time_max is None or self.time_max < process_time:
+            self.time_max = process_time
+
+        if process_time > 0.0:
+            key = math.ceil(math.log(process_time) / self.log_gamma)
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+            if len(self.buckets) > self.max_buckets:
+                self.collapse()
+        else:
+            self.zero_count += 1
+
+    def merge(self, sketch):
+        if self.gamma != sketch.gamma:
+            raise Exception('Could not merge sketches with different relative error')
+        self.count += sketch.count
+        self.time_sum += sketch.time_sum
+        if sketch.time_max is not None and (self.time_max is None or self.time_max < sketch.time_max):
+            self.time_max = sketch.time_max
+        self.zero_count += sketch.zero_count
+        for key, count in sketch.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self.collapse()
+
+    def collapse(self):
+        keys = sorted(self.buckets)
+        collapsed_count = 0
+        for key in keys[:len(keys) - self.max_buckets + 1]:
+            collapsed_count += self.buckets.pop(key)
+        key = keys[len(keys) - self.max_buckets]
+        self.buckets[key] = self.buckets.get(key, 0) + collapsed_count
+
+    def quantile(self, rank):
+        """Estimate value which has given rank in sorted process times"""
+        if rank < self.zero_count:
+            return 0.0
+        rank -= self.zero_count
+        for key in sorted(self.buckets):
+            rank -= self.buckets[key]
+            if rank < 0:
+                return min(2 * self.gamma ** key / (self.gamma + 1), self.time_max)
+        return self.time_max
+
+    def median(self):
+        return self.quantile(self.count // 2)
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y%m%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError('date must be in format YYYYMMDD: {}'.format(value))
 
 
 def prepare_environment():
     args_parser = argparse.ArgumentParser()
     args_parser.add_argument("--config", help="path to configuration file in json format", type=str)
+    args_parser.add_argument("--force", help="render report even if it exists", action='store_true')
+    args_parser.add_argument(
+        "--from", help="make report for logs starting from date YYYYMMDD", type=parse_date, dest='date_from')
+    args_parser.add_argument("--to", help="make report for logs up to date YYYYMMDD", type=parse_date, dest='date_to')
+    args_parser.add_argument("--days", help="make report for logs of last N days", type=int)
+    args_parser.add_argument(
+        "--follow", help="keep live report for growing log up to date until interrupted", action='store_true')
+    args_parser.add_argument(
+        "--unprocessed", help="make report for every log not processed yet", action='store_true')
     args = args_parser.parse_args()
+    if args.days is not None and (args.date_from is not None or args.date_to is not None):
+        args_parser.error('--days could not be used with --from or --to')
+    if args.days is not None and args.days < 1:
+        args_parser.error('--days must be positive')
+    if args.follow and (args.days is not None or args.date_from is not None or args.date_to is not None):
+        args_parser.error('--follow could not be used with --from, --to or --days')
+    if args.unprocessed and (args.follow or args.days is not None or args.date_from is not None or
+                             args.date_to is not None):
+        args_parser.error('--unprocessed could not be used with --follow, --from, --to or --days')
 
     config = Config(args.config)
 
@@ -84,7 +441,7 @@ def prepare_environment():
     if not report_dir_path.is_dir():
         report_dir_path.mkdir(parents=True, exist_ok=True)
 
-    return config
+    return config, args
 
 
 def dump_config(config):
@@ -95,34 +452,140 @@ def dump_config(config):
         logging.info('\t%s: %s', k, v)
 
 
-def find_last_log(config):
-    log_info = None
+def scan_log_dir(log_dir_path):
+    """
+    Logs in directory as (date, file name, is_gz) with date as YYYYMMDD string.
+    Type of entry is taken from scandir, so file is not stat-ed in most cases.
+    """
+    logs = []
+    with os.scandir(str(log_dir_path)) as entries:
+        for entry in entries:
+            if not entry.name.startswith(LOG_NAME_PREFIX):
+                continue
+            match = LOG_NAME_PATTERN.fullmatch(entry.name)
+            if match is not None and entry.is_file():
+                logs.append((match.group(1), entry.name, match.group(2) is not None))
+    return logs
 
-    log_dir_path = pathlib.Path(config.LOG_DIR)
-    if log_dir_path.is_dir():
 
-        last_file_path = None
-        last_date = None
-        last_is_gz = None
+class LogIndex:
+    """
+    Logs of LOG_DIR sorted by date, one log per date, with names of already
+    processed logs. If LOG_INDEX_PATH is set, index is kept there and
+    directory is scanned again only when its mtime changes.
+    """
 
-        for file_path in log_dir_path.iterdir():
-            if not file_path.is_file():
-                continue
+    def __init__(self, config):
+        self.log_dir_path = pathlib.Path(config.LOG_DIR)
+        self.index_path = None if config.LOG_INDEX_PATH is None else pathlib.Path(config.LOG_INDEX_PATH)
+        self.dir_mtime_ns = None
+        self.logs = []
+        self.dates = []
+        self.processed = set()
+        self.changed = False
+        self.scanned = False
+        self.load()
+        self.refresh()
 
-            match = re.fullmatch(LOG_NAME_PATTERN, file_path.name)
-            if match is not None:
-                date = datetime.datetime.strptime(match.group(1), "%Y%m%d")
-                if last_date is None or last_date < date:
-                    last_file_path = file_path
-                    last_date = date
-                    last_is_gz = match.group(2) is not None
+    def load(self):
+        if self.index_path is None or not self.index_path.is_file():
+            return
+        try:
+            index = json.loads(self.index_path.read_text())
+        except ValueError as e:
+            logging.info('Log index %s is broken: %s', self.index_path, e)
+            return
+        if index.get('version') != LOG_INDEX_VERSION or index.get('log_dir') != str(self.log_dir_path.resolve()):
+            logging.info('Log index %s is outdated', self.index_path)
+            return
+        self.dir_mtime_ns = index['dir_mtime_ns']
+        self.set_logs([tuple(log) for log in index['logs']])
+        self.processed = set(index['processed'])
 
-        if last_file_path is not None:
-            log_info = LogInfo(last_file_path, last_date, last_is_gz)
-    else:
-        logging.info('Log dir %s not found', log_dir)
+    def set_logs(self, logs):
+        logs_by_date = {}
+        for date, name, is_gz in sorted(logs):
+            logs_by_date.setdefault(date, (date, name, is_gz))
+        self.logs = [logs_by_date[date] for date in sorted(logs_by_date)]
+        self.dates = [log[0] for log in self.logs]
+
+    def refresh(self):
+        try:
+            dir_mtime_ns = os.stat(str(self.log_dir_path)).st_mtime_ns
+        except FileNotFoundError:
+            logging.info('Log dir %s not found', self.log_dir_path)
+            self.dir_mtime_ns = None
+            self.set_logs([])
+            return
+        if dir_mtime_ns == self.dir_mtime_ns:
+            return
+
+        scan_time_ns = time.time_ns()
+        self.set_logs(scan_log_dir(self.log_dir_path))
+        self.scanned = True
+        self.changed = True
+        names = {log[1] for log in self.logs}
+        self.processed &= names
+        # directory changed within mtime resolution could change again with
+        # the same mtime, so it is scanned next time too
+        if scan_time_ns - dir_mtime_ns > LOG_INDEX_RACY_INTERVAL * 1e9:
+            self.dir_mtime_ns = dir_mtime_ns
+        else:
+            self.dir_mtime_ns = None
+
+    def save(self):
+        if self.index_path is None or not self.changed:
+            return
+        index = {
+            'version': LOG_INDEX_VERSION,
+            'log_dir': str(self.log_dir_path.resolve()),
+            'dir_mtime_ns': self.dir_mtime_ns,
+            'logs': self.logs,
+            'processed': sorted(self.processed)
+        }
+        tmp_index_path = self.index_path.with_suffix(self.index_path.suffix + '.tmp')
+        try:
+            tmp_index_path.write_text(json.dumps(index))
+            tmp_index_path.rename(self.index_path)
+        finally:
+            if tmp_index_path.is_file():
+                tmp_index_path.unlink()
+        self.changed = False
+
+    def make_log_info(self, log):
+        date, name, is_gz = log
+        return LogInfo(self.log_dir_path / name, datetime.datetime.strptime(date, "%Y%m%d"), is_gz)
+
+    def iterate_logs(self):
+        for log in self.logs:
+            yield self.make_log_info(log)
 
-    return log_info
+    def find_last_log(self):
+        return self.make_log_info(self.logs[-1]) if self.logs else None
+
+    def find_logs(self, date_from=None, date_to=None):
+        """Logs with date in range [date_from, date_to] sorted by date"""
+        start = 0 if date_from is None else bisect.bisect_left(self.dates, date_from.strftime("%Y%m%d"))
+        end = len(self.dates) if date_to is None else bisect.bisect_right(self.dates, date_to.strftime("%Y%m%d"))
+        return [self.make_log_info(log) for log in self.logs[start:end]]
+
+    def find_unprocessed_logs(self):
+        return [self.make_log_info(log) for log in self.logs if log[1] not in self.processed]
+
+    def mark_processed(self, log_infos):
+        for log_info in log_infos:
+            if log_info.file_path.name not in self.processed:
+                self.processed.add(log_info.file_path.name)
+                self.changed = True
+
+
+def find_last_log(config):
+    return LogIndex(config).find_last_log()
+
+
+def find_logs(config, date_from=None, date_to=None):
+    """Logs with date in range [date_from, date_to] sorted by date, one log per date"""
+    return LogIndex(config).find_logs(date_from, date_to)
 
 
 def make_report_file_path(config, log_info):
@@ -132,56 +595,609 @@ def make_report_file_path(config, log_info):
     return pathlib.Path(config.REPORT_DIR) / report_file_name
 
 
-def parse_log(config, log_info):
-    open_func = gzip.open if log_info.is_gz else open
-    with open_func(str(log_info.file_path), 'rt') as log_file:
-        line_count = 0
-        error_count = 0
-        for line in log_file:
-            line_count += 1
-            match = re.fullmatch(LOG_PARSE_PATTERN, line)
-            if match:
-                yield LogRecord(match.group(1), float(match.group(2)))
-            else:
-                error_count += 1
-        logging.info('Processed %d lines with %d errors', line_count, error_count)
-        if line_count > 0 and error_count / line_count > config.PARSE_ERROR_RATE:
-            raise Exception('Too many unparsed lines')
+def make_follow_report_file_path(config):
+    template_file_path = pathlib.Path(config.REPORT_TEMPLATE)
+    report_file_name = template_file_path.stem + '-live' + template_file_path.suffix
+    return pathlib.Path(config.REPORT_DIR) / report_file_name
+
+
+def make_range_report_file_path(config, log_infos):
+    template_file_path = pathlib.Path(config.REPORT_TEMPLATE)
+    report_file_dates = log_infos[0].date.strftime('%Y.%m.%d') + '-' + log_infos[-1].date.strftime('%Y.%m.%d')
+    report_file_name = template_file_path.stem + '-' + report_file_dates + template_file_path.suffix
+    return pathlib.Path(config.REPORT_DIR) / report_file_name
+
+
+def make_aggregate_file_path(config, log_info):
+    aggregate_file_date = log_info.date.strftime('%Y.%m.%d')
+    return pathlib.Path(config.REPORT_DIR) / ('aggregate-' + aggregate_file_date + '.pickle')
+
+
+def read_gz_chunks(file_path):
+    with open(str(file_path), 'rb') as log_file:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        member_started = False
+        while True:
+            data = log_file.read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            while data:
+                member_started = True
+                yield decompressor.decompress(data)
+                if not decompressor.eof:
+                    break
+                # gzip file could contain several concatenated members
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                member_started = False
+        if member_started:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def read_gz_chunks_external(gzip_command, file_path):
+    """Decompress in separate process, so decompression and parsing use different cores"""
+    with subprocess.Popen(gzip_command + [str(file_path)], stdout=subprocess.PIPE) as process:
+        while True:
+            data = process.stdout.read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+    if process.returncode != 0:
+        raise Exception('{} exited with code {}'.format(gzip_command[0], process.returncode))
+
+
+def read_plain_chunks(file_path, start=0, end=None):
+    with open(str(file_path), 'rb') as log_file:
+        size = os.fstat(log_file.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+            for pos in range(start, end, READ_CHUNK_SIZE):
+                yield log_map[pos:min(pos + READ_CHUNK_SIZE, end)]
+
+
+def get_gzip_command(config):
+    if config.GZIP_COMMAND is None:
+        return None
+    gzip_command = shlex.split(config.GZIP_COMMAND)
+    if shutil.which(gzip_command[0]) is None:
+        logging.info('%s not found, decompress with zlib', gzip_command[0])
+        return None
+    return gzip_command
+
+
+def read_log_chunks(config, log_info):
+    if not log_info.is_gz:
+        return read_plain_chunks(log_info.file_path)
+    gzip_command = get_gzip_command(config)
+    if gzip_command is not None:
+        return read_gz_chunks_external(gzip_command, log_info.file_path)
+    return read_gz_chunks(log_info.file_path)
+
+
+def count_data(chunks, parse_stat):
+    for chunk in chunks:
+        parse_stat.data_size += len(chunk)
+        parse_stat.report_progress()
+        yield chunk
+
+
+def split_lines(chunks):
+    """Split chunks of bytes on lines without line ends"""
+    tail = b''
+    for chunk in chunks:
+        lines = chunk.split(b'\n')
+        lines[0] = tail + lines[0]
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+class LogTail:
+    """
+    Read lines appended to log file since previous read. When file is
+    rotated or truncated it is reopened and read from the beginning.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.log_file = None
+        self.inode = None
+        self.tail = b''
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        self.tail = b''
+
+    def is_rotated(self):
+        """Returns True if file is not opened yet or was replaced or truncated"""
+        try:
+            stat = self.file_path.stat()
+        except FileNotFoundError:
+            # old file is still read until new one is created
+            return False
+        return self.log_file is None or stat.st_ino != self.inode or stat.st_size < self.log_file.tell()
+
+    def reopen(self):
+        self.close()
+        self.log_file = open(str(self.file_path), 'rb')
+        self.inode = os.fstat(self.log_file.fileno()).st_ino
+
+    def read_lines(self, final=False):
+        """
+        Yields chunks of complete new lines without line ends. If final,
+        incomplete last line is yielded too, as file is not written any more
+        """
+        if self.log_file is None:
+            return
+        while True:
+            data = self.log_file.read(READ_CHUNK_SIZE)
+            if not data:
+                break
+            lines = data.split(b'\n')
+            lines[0] = self.tail + lines[0]
+            self.tail = lines.pop()
+            if lines:
+                yield lines
+        if final and self.tail:
+            yield [self.tail]
+            self.tail = b''
+
+
+def parse_line_regex(line):
+    match = re.fullmatch(LOG_PARSE_PATTERN, line)
+    if match:
+        return LogRecord(match.group(1), float(match.group(2)))
+    return None
+
+
+def parse_line(line):
+    """
+    Parse line of bytes without line end the same way as LOG_PARSE_PATTERN
+    does with decoded line but without backtracking: url is the second word
+    of request after '] "' and process time is the last word of line.
+    Only url is decoded.
+    """
+    if line[-1:] == b'\r':
+        line = line[:-1]
+
+    request_pos = line.find(b'] "')
+    if request_pos < 1:
+        return None
+
+    method_end = line.find(b' ', request_pos + 3)
+    if method_end < 0 or method_end == request_pos + 3 or b'"' in line[request_pos + 3:method_end]:
+        return None
+
+    url_end = line.find(b' ', method_end + 1)
+    if url_end < 0 or url_end == method_end + 1:
+        return None
+    url = line[method_end + 1:url_end]
+    if b'"' in url:
+        return None
+
+    time_pos = line.rfind(b' ')
+    if time_pos < url_end + 2:
+        return None
+    process_time = line[time_pos + 1:]
+    if not process_time or process_time.strip(b'0123456789.'):
+        return None
+    try:
+        return LogRecord(url.decode(errors='replace'), float(process_time))
+    except ValueError:
+        return None
+
+
+def parse_lines(lines, parse_stat):
+    for line in lines:
+        parse_stat.line_count += 1
+        log_record = parse_line(line)
+        if log_record is not None:
+            yield log_record
+        else:
+            parse_stat.add_error(line)
+
+
+def log_error_lines(parse_stat):
+    for line in parse_stat.error_lines:
+        logging.error('Unparsed line: %r', line)
+
+
+def check_parse_stat(config, parse_stat):
+    logging.info('Processed %d lines with %d errors', parse_stat.line_count, parse_stat.error_count)
+    if parse_stat.line_count > 0 and parse_stat.error_count / parse_stat.line_count > config.PARSE_ERROR_RATE:
+        log_error_lines(parse_stat)
+        raise Exception('Too many unparsed lines')
+
+
+def parse_log(config, log_info, parse_stat=None):
+    if parse_stat is None:
+        parse_stat = make_parse_stat(config)
+    yield from parse_lines(split_lines(count_data(read_log_chunks(config, log_info), parse_stat)), parse_stat)
+    check_parse_stat(config, parse_stat)
+
+
+def make_url_normalizer(config):
+    """
+    Function to normalize url according to config, or None if urls should
+    be left as is. Rules are compiled once and results are cached.
+    """
+    rewrite_rules = [(re.compile(pattern), replacement) for pattern, replacement in config.URL_REWRITE_RULES]
+    if not config.URL_DROP_QUERY and not config.URL_COLLAPSE_IDS and not rewrite_rules:
+        return None
+
+    @functools.lru_cache(maxsize=URL_NORMALIZE_CACHE_SIZE)
+    def normalize_url(url):
+        path, separator, query = url.partition('?')
+        if config.URL_DROP_QUERY:
+            separator = query = ''
+        if config.URL_COLLAPSE_IDS:
+            path = NUMERIC_SEGMENT_PATTERN.sub('/{id}', path)
+            path = UUID_SEGMENT_PATTERN.sub('/{uuid}', path)
+        url = path + separator + query
+        for pattern, replacement in rewrite_rules:
+            url = pattern.sub(replacement, url)
+        return url
+
+    return normalize_url
+
+
+def normalize_urls(config, parse_log_it):
+    normalize_url = make_url_normalizer(config)
+    if normalize_url is None:
+        return parse_log_it
+    return (LogRecord(normalize_url(log_record.url), log_record.process_time) for log_record in parse_log_it)
+
+
+def make_urls_info(config, info):
+    # fsum is exact, so total does not depend on order of records
+    # and parallel processing gives the same result as serial one
+    if config.AGGREGATION == AGGREGATION_SKETCH:
+        count = sum(sketch.count for sketch in info.values())
+        time_sum = math.fsum(sketch.time_sum for sketch in info.values())
+    else:
+        count = sum(len(process_times) for process_times in info.values())
+        time_sum = math.fsum(itertools.chain.from_iterable(info.values()))
+    return UrlsInfo(info, count, time_sum)
+
+
+def check_aggregation(config):
+    if config.AGGREGATION not in (AGGREGATION_EXACT, AGGREGATION_SKETCH):
+        raise Exception('Unknown aggregation mode: {}'.format(config.AGGREGATION))
 
 
 def collect_url_info(config, parse_log_it):
+    """
+    Collect process times by url. When URL_MAX_COUNT urls are tracked,
+    new urls are collected as OTHER_URL
+    """
+    check_aggregation(config)
     info = {}
-    count = 0
-    time_sum = 0.0
+    max_count = config.URL_MAX_COUNT
 
-    for log_record in parse_log_it:
-        count += 1
-        time_sum += log_record.process_time
+    if config.AGGREGATION == AGGREGATION_SKETCH:
+        for log_record in parse_log_it:
+            url = log_record.url
+            if url not in info:
+                if max_count is not None and len(info) >= max_count:
+                    url = OTHER_URL
+                if url not in info:
+                    info[url] = UrlSketch(config.SKETCH_RELATIVE_ERROR, config.SKETCH_MAX_BUCKETS)
+            info[url].add(log_record.process_time)
+    else:
+        # array of doubles takes 8 bytes per process time instead of
+        # 32 bytes for float object and pointer to it in list
+        for log_record in parse_log_it:
+            url = log_record.url
+            if url not in info:
+                if max_count is not None and len(info) >= max_count:
+                    url = OTHER_URL
+                if url not in info:
+                    info[url] = array.array('d')
+            info[url].append(log_record.process_time)
 
-        if log_record.url not in info:
-            info[log_record.url] = []
-        info[log_record.url].append(log_record.process_time)
+    return make_urls_info(config, info)
 
-    return UrlsInfo(info, count, time_sum)
 
+def update_info(config, info, urls_info, time_sums=None):
+    """
+    Add statistic from urls_info to info in place. In exact mode running
+    time sums by url are added to time_sums if it is given, so top urls
+    are selected without summing all process times again
+    """
+    max_count = config.URL_MAX_COUNT
 
-def make_report_info(config, urls_info):
-    report_info = []
-    for url, process_times in urls_info.info.items():
-        process_times.sort()
-
-        report_record = {
-            'url': url,
-            'count': len(process_times),
-            'time_med': process_times[len(process_times) // 2],
-            'time_sum': 0.0,
-            'time_max': None
+    for url, url_info in urls_info.info.items():
+        if url not in info:
+            if max_count is not None and len(info) >= max_count:
+                url = OTHER_URL
+            if url not in info:
+                if config.AGGREGATION == AGGREGATION_SKETCH:
+                    info[url] = UrlSketch(config.SKETCH_RELATIVE_ERROR, config.SKETCH_MAX_BUCKETS)
+                else:
+                    info[url] = array.array('d')
+        if config.AGGREGATION == AGGREGATION_SKETCH:
+            info[url].merge(url_info)
+        else:
+            info[url].extend(url_info)
+            if time_sums is not None:
+                time_sums[url] = time_sums.get(url, 0.0) + math.fsum(url_info)
+
+
+def merge_urls_info(config, urls_info_it):
+    check_aggregation(config)
+    info = {}
+
+    for urls_info in urls_info_it:
+        update_info(config, info, urls_info)
+
+    return make_urls_info(config, info)
+
+
+def find_line_boundaries(config, log_info):
+    """Split plain log on byte ranges of PARSE_CHUNK_SIZE aligned to line ends"""
+    boundaries = [0]
+    with open(str(log_info.file_path), 'rb') as log_file:
+        log_file.seek(0, io.SEEK_END)
+        size = log_file.tell()
+        while boundaries[-1] + config.PARSE_CHUNK_SIZE < size:
+            log_file.seek(boundaries[-1] + config.PARSE_CHUNK_SIZE)
+            log_file.readline()
+            if log_file.tell() >= size:
+                break
+            boundaries.append(log_file.tell())
+    boundaries.append(size)
+    return boundaries
+
+
+def split_log(config, log_info, parse_stat):
+    if log_info.is_gz:
+        lines_it = split_lines(count_data(read_log_chunks(config, log_info), parse_stat))
+        while True:
+            lines = list(itertools.islice(lines_it, config.PARSE_BATCH_LINES))
+            if not lines:
+                break
+            yield LogPart(log_info, None, None, lines)
+    else:
+        boundaries = find_line_boundaries(config, log_info)
+        for start, end in zip(boundaries, boundaries[1:]):
+            yield LogPart(log_info, start, end, None)
+
+
+def process_log_part(config, log_part):
+    # error rate is checked by parent process on counters of all parts
+    parse_stat = ParseStat(error_sample_size=config.PARSE_ERROR_SAMPLES)
+    if log_part.lines is not None:
+        lines = log_part.lines
+    else:
+        chunks = read_plain_chunks(log_part.log_info.file_path, log_part.start, log_part.end)
+        lines = split_lines(count_data(chunks, parse_stat))
+    urls_info = collect_url_info(config, normalize_urls(config, parse_lines(lines, parse_stat)))
+    return urls_info, parse_stat
+
+
+def collect_parts(parts_it, parse_stat):
+    for urls_info, part_parse_stat in parts_it:
+        parse_stat.update(part_parse_stat)
+        yield urls_info
+
+
+def process_log_parallel(config, log_info, parse_stat):
+    # pool runs split_log in its task handler thread, so decompressed bytes
+    # of gz log are counted apart and added in this thread after the pool
+    read_stat = ParseStat()
+    with multiprocessing.Pool(config.PARSE_WORKERS) as pool:
+        process_func = functools.partial(process_log_part, config)
+        parts_it = pool.imap(process_func, split_log(config, log_info, read_stat))
+        urls_info = merge_urls_info(config, collect_parts(parts_it, parse_stat))
+    parse_stat.update(read_stat)
+    check_parse_stat(config, parse_stat)
+    return urls_info
+
+
+def process_log(config, log_info, total_parse_stat=None):
+    """Parse and collect statistic of log, parse counters are added to total_parse_stat"""
+    parse_stat = make_parse_stat(config, None if total_parse_stat is None else total_parse_stat.progress)
+    parse_stat.file_size = log_info.file_path.stat().st_size
+
+    if config.PARSE_WORKERS is None or config.PARSE_WORKERS > 1:
+        urls_info = process_log_parallel(config, log_info, parse_stat)
+    else:
+        urls_info = collect_url_info(config, normalize_urls(config, parse_log(config, log_info, parse_stat)))
+
+    if total_parse_stat is not None:
+        total_parse_stat.update(parse_stat)
+    return urls_info
+
+
+def make_aggregate_key(config, log_info):
+    """Aggregate is valid only for the same log file and aggregation settings"""
+    stat = log_info.file_path.stat()
+    return {
+        'version': AGGREGATE_VERSION,
+        'file_path': str(log_info.file_path.resolve()),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'settings': {
+            key: config.config[key]
+            for key in ('AGGREGATION', 'SKETCH_RELATIVE_ERROR', 'SKETCH_MAX_BUCKETS',
+                        'URL_DROP_QUERY', 'URL_COLLAPSE_IDS', 'URL_REWRITE_RULES', 'URL_MAX_COUNT')
         }
+    }
+
+
+def load_aggregate(config, log_info):
+    if not config.AGGREGATE_CACHE:
+        return None
+
+    aggregate_file_path = make_aggregate_file_path(config, log_info)
+    if not aggregate_file_path.is_file():
+        return None
+
+    try:
+        with open(str(aggregate_file_path), 'rb') as aggregate_file:
+            if pickle.load(aggregate_file) != make_aggregate_key(config, log_info):
+                logging.info('Aggregate %s is outdated', aggregate_file_path)
+                return None
+            urls_info = pickle.load(aggregate_file)
+    except (pickle.UnpicklingError, EOFError, AttributeError, ValueError) as e:
+        logging.info('Aggregate %s is broken: %s', aggregate_file_path, e)
+        return None
+
+    logging.info('Aggregate loaded: %s', aggregate_file_path)
+    return urls_info
+
+
+def save_aggregate(config, log_info, urls_info):
+    if not config.AGGREGATE_CACHE:
+        return
 
-        for process_time in process_times:
-            report_record['time_sum'] += process_time
-            if report_record['time_max'] is None or report_record['time_max'] < process_time:
-                report_record['time_max'] = process_time
+    aggregate_file_path = make_aggregate_file_path(config, log_info)
+    tmp_aggregate_file_path = aggregate_file_path.with_suffix(aggregate_file_path.suffix + '.tmp')
+    try:
+        with open(str(tmp_aggregate_file_path), 'wb') as aggregate_file:
+            pickle.dump(make_aggregate_key(config, log_info), aggregate_file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(urls_info, aggregate_file, pickle.HIGHEST_PROTOCOL)
+        tmp_aggregate_file_path.rename(aggregate_file_path)
+    finally:
+        if tmp_aggregate_file_path.is_file():
+            tmp_aggregate_file_path.unlink()
+    logging.info('Aggregate saved: %s', aggregate_file_path)
+
+
+def process_and_save_log(config, log_info, total_parse_stat=None):
+    urls_info = process_log(config, log_info, total_parse_stat)
+    save_aggregate(config, log_info, urls_info)
+    return urls_info
+
+
+def process_and_save_log_part(config, log_info):
+    """Process log in worker, returning parse counters with statistic"""
+    parse_stat = ParseStat()
+    urls_info = process_and_save_log(config, log_info, parse_stat)
+    return urls_info, parse_stat
+
+
+def collect_log(config, log_info, total_parse_stat=None):
+    urls_info = load_aggregate(config, log_info)
+    if urls_info is None:
+        urls_info = process_and_save_log(config, log_info, total_parse_stat)
+    return urls_info
+
+
+def make_serial_config(config):
+    """Config for worker process, which could not start pool of its own"""
+    serial_config = copy.copy(config)
+    serial_config.config = dict(config.config, PARSE_WORKERS=1)
+    return serial_config
+
+
+def collect_logs(config, log_infos, total_parse_stat=None):
+    """Collect statistic for every log, reusing aggregates, and merge it in order of dates"""
+    urls_infos = [load_aggregate(config, log_info) for log_info in log_infos]
+    missing_log_infos = [log_info for log_info, urls_info in zip(log_infos, urls_infos) if urls_info is None]
+
+    if len(missing_log_infos) > 1 and (config.PARSE_WORKERS is None or config.PARSE_WORKERS > 1):
+        with multiprocessing.Pool(config.PARSE_WORKERS) as pool:
+            process_func = functools.partial(process_and_save_log_part, make_serial_config(config))
+            missing_urls_infos = []
+            for urls_info, parse_stat in pool.imap(process_func, missing_log_infos):
+                missing_urls_infos.append(urls_info)
+                if total_parse_stat is not None:
+                    total_parse_stat.update(parse_stat)
+    else:
+        missing_urls_infos = [
+            process_and_save_log(config, log_info, total_parse_stat) for log_info in missing_log_infos
+        ]
+
+    missing_urls_infos_it = iter(missing_urls_infos)
+    urls_infos = [next(missing_urls_infos_it) if urls_info is None else urls_info for urls_info in urls_infos]
+
+    return merge_urls_info(config, urls_infos)
+
+
+def select_top_urls(config, urls_info, url_time_sums=None):
+    """
+    Urls with the biggest time_sum in descending order with their time_sum.
+    Only compact list of totals is built for all urls, the same order as
+    stable sort of all urls gives. In exact mode time_sum is math.fsum of
+    process times, correctly rounded and independent of their order, so
+    it could differ in last digits from sequential sum of sorted times in
+    old reports, and urls with such close sums could swap. Running time
+    sums by url may be given in url_time_sums instead of summing all
+    process times.
+    """
+    urls = list(urls_info.info)
+    if config.AGGREGATION == AGGREGATION_SKETCH:
+        time_sums = [sketch.time_sum for sketch in urls_info.info.values()]
+    elif url_time_sums is not None:
+        time_sums = [url_time_sums[url] for url in urls]
+    else:
+        time_sums = [math.fsum(process_times) for process_times in urls_info.info.values()]
+    top_indexes = heapq.nlargest(config.REPORT_SIZE, range(len(urls)), key=time_sums.__getitem__)
+    return [(urls[index], time_sums[index]) for index in top_indexes]
+
+
+def select_median(process_times, sample_size=1000, margin=30):
+    """
+    Process time at position len // 2 of sorted process times, the same
+    as baseline median, without list of float objects for all times.
+    Bounds around median are taken from random sample, counting is done
+    by builtins over array and only times between bounds are kept
+    """
+    k = len(process_times) // 2
+    while len(process_times) > sample_size:
+        sample = sorted(random.sample(process_times, sample_size))
+        position = k * sample_size // len(process_times)
+        low = sample[max(position - margin, 0)]
+        high = sample[min(position + margin, sample_size - 1)]
+
+        below_low = sum(map(low.__gt__, process_times))
+        if k < below_low:
+            process_times = array.array('d', filter(low.__gt__, process_times))
+            continue
+        up_to_low = below_low + process_times.count(low)
+        if k < up_to_low:
+            return low
+
+        up_to_high = sum(map(high.__ge__, process_times))
+        if k >= up_to_high:
+            process_times = array.array('d', filter(high.__lt__, process_times))
+            k -= up_to_high
+            continue
+        if k >= up_to_high - process_times.count(high):
+            return high
+
+        # low and high are excluded, so times shrink on every pass
+        process_times = array.array('d', filter(low.__lt__, filter(high.__gt__, process_times)))
+        k -= up_to_low
+    return sorted(process_times)[k]
+
+
+def make_report_info(config, urls_info, url_time_sums=None):
+    report_info = []
+    for url, time_sum in select_top_urls(config, urls_info, url_time_sums):
+        url_info = urls_info.info[url]
+        if config.AGGREGATION == AGGREGATION_SKETCH:
+            report_record = {
+                'url': url,
+                'count': url_info.count,
+                'time_med': url_info.median(),
+                'time_sum': time_sum,
+                'time_max': url_info.time_max
+            }
+        else:
+            report_record = {
+                'url': url,
+                'count': len(url_info),
+                'time_med': select_median(url_info),
+                'time_sum': time_sum,
+                'time_max': max(url_info)
+            }
 
         report_record['count_perc'] = report_record['count'] / urls_info.count * 100
         report_record['time_perc'] = report_record['time_sum'] / urls_info.time_sum * 100
@@ -189,44 +1205,259 @@ def make_report_info(config, urls_info):
 
         report_info.append(report_record)
 
-    report_info.sort(key=lambda ri: ri['time_sum'], reverse=True)
+    return report_info
 
-    del report_info[config.REPORT_SIZE:]
 
-    return report_info
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def load_template(template_file_name, mtime_ns, size):
+    """
+    Template split into literal text and TABLE_JSON markers for every
+    $table_json placeholder, with the same result as Template.safe_substitute:
+    $$ is unescaped, other placeholders are left as is. Cached by file
+    name, mtime and size.
+    """
+    template_text = pathlib.Path(template_file_name).read_text()
+    parts = []
+    text_start = 0
+    for match in Template.pattern.finditer(template_text):
+        name = match.group('named') or match.group('braced')
+        if name == 'table_json':
+            replacement = TABLE_JSON
+        elif match.group('escaped') is not None:
+            replacement = Template.delimiter
+        else:
+            continue
+        parts.append(template_text[text_start:match.start()])
+        parts.append(replacement)
+        text_start = match.end()
+    parts.append(template_text[text_start:])
+    return [part for part in parts if part]
+
+
+def iterencode_table(report_info):
+    """Json of report rows one by one, the same as json.dumps of whole list"""
+    separator = '['
+    for row in report_info:
+        yield separator
+        yield json.dumps(row)
+        separator = ', '
+    yield '[]' if separator == '[' else ']'
 
 
 def render_report(config, report_file_path, report_info):
-    table_json = json.dumps(report_info)
     template_file_path = pathlib.Path(config.REPORT_TEMPLATE)
-    template = Template(template_file_path.read_text())
+    template_stat = template_file_path.stat()
+    template_parts = load_template(str(template_file_path), template_stat.st_mtime_ns, template_stat.st_size)
     tmp_report_file_path = report_file_path.with_suffix(report_file_path.suffix + '.tmp')
     try:
-        tmp_report_file_path.write_text(template.safe_substitute(table_json=table_json))
+        with open(str(tmp_report_file_path), 'w') as report_file:
+            for part in template_parts:
+                if part is TABLE_JSON:
+                    report_file.writelines(iterencode_table(report_info))
+                else:
+                    report_file.write(part)
         tmp_report_file_path.rename(report_file_path)
     finally:
         if tmp_report_file_path.is_file():
             tmp_report_file_path.unlink()
 
 
-def main():
-    config = prepare_environment()
-    dump_config(config)
+def make_log_report(config, args, metrics, log_index, log_info):
+    """Make report for one log and mark it processed in index"""
+    report_file_path = make_report_file_path(config, log_info)
+    if report_file_path.is_file() and not args.force:
+        logging.info('Report exists: %s', report_file_path)
+        log_index.mark_processed([log_info])
+        return
 
-    log_info = find_last_log(config)
-    logging.info('Last log file found: %s', log_info.file_path)
+    with metrics.stage('collect'):
+        urls_info = collect_log(config, log_info, metrics.parse_stat)
+    metrics.url_count = (metrics.url_count or 0) + len(urls_info.info)
+    with metrics.stage('make_report'):
+        report_info = make_report_info(config, urls_info)
 
-    report_file_path = make_report_file_path(config, log_info)
-    if report_file_path.is_file():
+    logging.info('Render report %s', report_file_path)
+    with metrics.stage('render_report'):
+        render_report(config, report_file_path, report_info)
+    log_index.mark_processed([log_info])
+
+
+def make_last_report(config, args, metrics):
+    with metrics.stage('find_log'):
+        log_index = LogIndex(config)
+        log_info = log_index.find_last_log()
+    if log_info is None:
+        logging.info('No log file found')
+    else:
+        logging.info('Last log file found: %s', log_info.file_path)
+        make_log_report(config, args, metrics, log_index, log_info)
+    log_index.save()
+
+
+def make_unprocessed_reports(config, args, metrics):
+    """
+    Make report for every log which is not marked processed in index, so
+    logs missed by previous runs are caught up. Index is saved after every
+    log, so interrupted run continues from the next log.
+    """
+    with metrics.stage('find_log'):
+        log_index = LogIndex(config)
+        log_infos = log_index.find_unprocessed_logs()
+    logging.info('Unprocessed log files found: %d', len(log_infos))
+    for log_info in log_infos:
+        logging.info('Log file: %s', log_info.file_path)
+        make_log_report(config, args, metrics, log_index, log_info)
+        log_index.save()
+    log_index.save()
+
+
+def make_range_report(config, args, metrics):
+    date_from = args.date_from
+    date_to = args.date_to
+    with metrics.stage('find_log'):
+        log_index = LogIndex(config)
+        if args.days is not None:
+            last_log_info = log_index.find_last_log()
+            if last_log_info is None:
+                logging.info('No log file found')
+                log_index.save()
+                return
+            date_to = last_log_info.date
+            date_from = date_to - datetime.timedelta(days=args.days - 1)
+
+        log_infos = log_index.find_logs(date_from, date_to)
+    if not log_infos:
+        logging.info('No log files found in range')
+        log_index.save()
+        return
+    logging.info('Log files found: %d from %s to %s', len(log_infos), log_infos[0].file_path, log_infos[-1].file_path)
+
+    report_file_path = make_range_report_file_path(config, log_infos)
+    if report_file_path.is_file() and not args.force:
         logging.info('Report exists: %s', report_file_path)
+        log_index.save()
         return
 
-    parse_log_it = parse_log(config, log_info)
-    urls_info = collect_url_info(config, parse_log_it)
-    report_info = make_report_info(config, urls_info)
+    with metrics.stage('collect'):
+        urls_info = collect_logs(config, log_infos, metrics.parse_stat)
+    metrics.url_count = len(urls_info.info)
+    with metrics.stage('make_report'):
+        report_info = make_report_info(config, urls_info)
 
     logging.info('Render report %s', report_file_path)
-    render_report(config, report_file_path, report_info)
+    with metrics.stage('render_report'):
+        render_report(config, report_file_path, report_info)
+    # range report does not make daily reports, so logs stay unprocessed
+    log_index.save()
+
+
+class LogFollower:
+    """Keep statistic of growing log and render live report from time to time"""
+
+    def __init__(self, config):
+        self.config = config
+        if config.FOLLOW_LOG_PATH is None:
+            self.log_file_path = pathlib.Path(config.LOG_DIR) / FOLLOW_LOG_NAME
+        else:
+            self.log_file_path = pathlib.Path(config.FOLLOW_LOG_PATH)
+        self.report_file_path = make_follow_report_file_path(config)
+        self.error_monitor = ErrorRateMonitor(config)
+        self.log_tail = LogTail(self.log_file_path)
+        self.reset()
+
+    def reset(self):
+        self.urls_info = make_urls_info(self.config, {})
+        # running time sums by url for exact mode, so refresh of report does
+        # not sum all process times: only top urls are sorted for median
+        self.url_time_sums = {}
+        self.parse_stat = ParseStat(error_sample_size=self.config.PARSE_ERROR_SAMPLES)
+        self.pending_line_count = 0
+        self.render_time = time.monotonic()
+
+    def add_lines(self, lines):
+        parse_stat = ParseStat(error_sample_size=self.config.PARSE_ERROR_SAMPLES)
+        urls_info = collect_url_info(self.config, normalize_urls(self.config, parse_lines(lines, parse_stat)))
+        update_info(self.config, self.urls_info.info, urls_info, self.url_time_sums)
+        self.urls_info = UrlsInfo(
+            self.urls_info.info,
+            self.urls_info.count + urls_info.count,
+            self.urls_info.time_sum + urls_info.time_sum)
+        self.parse_stat.update(parse_stat)
+        self.pending_line_count += parse_stat.line_count
+
+    def read(self):
+        """Collect statistic of new lines, returns True if there were any"""
+        has_lines = False
+        if self.log_tail.is_rotated():
+            # like tail -F, lines written to old file before rotation are
+            # read to the end and rendered in report of old file
+            for lines in self.log_tail.read_lines(final=True):
+                has_lines = True
+                self.add_lines(lines)
+            if self.pending_line_count > 0:
+                self.render()
+            self.log_tail.reopen()
+            logging.info('Follow log %s from the beginning', self.log_file_path)
+            self.reset()
+
+        for lines in self.log_tail.read_lines():
+            has_lines = True
+            self.add_lines(lines)
+            if self.pending_line_count >= self.config.FOLLOW_LINES:
+                break
+        return has_lines
+
+    def need_render(self):
+        if self.pending_line_count == 0:
+            return False
+        return (self.pending_line_count >= self.config.FOLLOW_LINES or
+                time.monotonic() - self.render_time >= self.config.FOLLOW_INTERVAL)
+
+    def render(self):
+        # follower does not stop because of broken lines, error rate is
+        # checked with warmup and confidence bound and only logged
+        if self.error_monitor.is_exceeded(self.parse_stat):
+            log_error_lines(self.parse_stat)
+            logging.error('Too many unparsed lines: %d errors in %d lines of %s',
+                          self.parse_stat.error_count, self.parse_stat.line_count, self.log_file_path)
+        report_info = make_report_info(self.config, self.urls_info, self.url_time_sums)
+        render_report(self.config, self.report_file_path, report_info)
+        self.pending_line_count = 0
+        self.render_time = time.monotonic()
+
+    def run(self):
+        logging.info('Follow log %s, live report %s', self.log_file_path, self.report_file_path)
+        try:
+            while True:
+                has_lines = self.read()
+                if self.need_render():
+                    self.render()
+                if not has_lines:
+                    time.sleep(FOLLOW_POLL_INTERVAL)
+        finally:
+            self.log_tail.close()
+
+
+def main():
+    config, args = prepare_environment()
+    dump_config(config)
+
+    if args.follow:
+        check_aggregation(config)
+        LogFollower(config).run()
+        return
+
+    metrics = Metrics(config)
+    try:
+        if args.days is not None or args.date_from is not None or args.date_to is not None:
+            make_range_report(config, args, metrics)
+        elif args.unprocessed:
+            make_unprocessed_reports(config, args, metrics)
+        else:
+            make_last_report(config, args, metrics)
+        metrics.success = True
+    finally:
+        metrics.save()
 
 
 if __name__ == "__main__":
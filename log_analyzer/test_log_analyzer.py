@@ -2,12 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import argparse
 import pathlib
 import subprocess
 import json
 import datetime
+import gzip
+import tempfile
+import threading
+import random
+import array
+import itertools
+import math
+import os
+import time
 
 import log_analyzer
+import benchmark
 
 
 class ScriptExecTest(unittest.TestCase):
@@ -15,11 +26,14 @@ class ScriptExecTest(unittest.TestCase):
 
         script_log_path = pathlib.Path('test') / 'log_analyzer.log'
         report_json_path = pathlib.Path('test') / 'report' / 'report-2017.06.30.json'
+        aggregate_path = pathlib.Path('test') / 'report' / 'aggregate-2017.06.30.pickle'
 
         if script_log_path.is_file():
             script_log_path.unlink()
         if report_json_path.is_file():
             report_json_path.unlink()
+        if aggregate_path.is_file():
+            aggregate_path.unlink()
 
         cmd = './log_analyzer.py --config test/config.json'
         subprocess.run(cmd, shell=True, check=True)
@@ -37,9 +51,43 @@ class ScriptExecTest(unittest.TestCase):
         self.assertAlmostEqual(report_json[0]['time_med'], 1.555)
         self.assertAlmostEqual(report_json[0]['count_perc'], 50)
         self.assertAlmostEqual(report_json[0]['time_perc'], 64.042076)
+        self.assertTrue(aggregate_path.is_file())
+
+        report_json_path.write_text('[]')
+        subprocess.run(cmd + ' --force', shell=True, check=True)
+        self.assertEqual(json.loads(report_json_path.read_text()), report_json)
+        self.assertIn('Aggregate loaded', script_log_path.read_text())
 
         script_log_path.unlink()
         report_json_path.unlink()
+        aggregate_path.unlink()
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_generate_log(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for is_gz in (False, True):
+                log_file_path = benchmark.generate_log(
+                    tmp_dir, 2000, 50, 0.1, datetime.datetime(2017, 7, 1), is_gz, 1)
+                log_info = log_analyzer.LogInfo(log_file_path, datetime.datetime(2017, 7, 1), is_gz)
+                config = log_analyzer.Config('test/config.json')
+                config.config.update(LOG_DIR=tmp_dir, REPORT_DIR=tmp_dir)
+                self.assertEqual(log_analyzer.find_last_log(config), log_info)
+
+                parse_stat = log_analyzer.ParseStat()
+                records = list(log_analyzer.parse_lines(
+                    log_analyzer.split_lines(log_analyzer.read_log_chunks(config, log_info)), parse_stat))
+                self.assertEqual(parse_stat.line_count, 2000)
+                self.assertAlmostEqual(parse_stat.error_count / parse_stat.line_count, 0.1, delta=0.03)
+                self.assertLessEqual(len({record.url for record in records}), 50)
+
+                results = benchmark.bench_stages(config)
+                self.assertEqual(results['record_count'], len(records))
+                self.assertEqual(set(results['stages']), {
+                    'find_last_log', 'parse_log', 'process_log', 'make_report_info', 'render_report'})
+                self.assertEqual(results['stages']['parse_log']['count'], len(records))
+                self.assertGreaterEqual(results['stages']['process_log']['peak_rss_growth'], 0)
+                log_file_path.unlink()
 
 
 class ConfigTest(unittest.TestCase):
@@ -54,7 +102,29 @@ class ConfigTest(unittest.TestCase):
                 'REPORT_DIR': 'test/report',
                 'REPORT_TEMPLATE': 'test/report.json',
                 'LOG_DIR': 'test/log',
+                'LOG_INDEX_PATH': None,
                 'PARSE_ERROR_RATE': 0.5,
+                'PARSE_ERROR_WARMUP': 10000,
+                'PARSE_ERROR_CONFIDENCE': 0.999,
+                'PARSE_ERROR_SAMPLES': 10,
+                'PARSE_WORKERS': 1,
+                'PARSE_CHUNK_SIZE': 64 * 1024 * 1024,
+                'PARSE_BATCH_LINES': 100000,
+                'GZIP_COMMAND': None,
+                'AGGREGATION': 'exact',
+                'SKETCH_RELATIVE_ERROR': 0.01,
+                'SKETCH_MAX_BUCKETS': 1024,
+                'AGGREGATE_CACHE': True,
+                'URL_DROP_QUERY': False,
+                'URL_COLLAPSE_IDS': False,
+                'URL_REWRITE_RULES': [],
+                'URL_MAX_COUNT': None,
+                'FOLLOW_LOG_PATH': None,
+                'FOLLOW_INTERVAL': 60,
+                'FOLLOW_LINES': 1000000,
+                'PROGRESS_INTERVAL': 60,
+                'METRICS_PATH': None,
+                'METRICS_FORMAT': 'json',
                 'SCRIPT_LOG_PATH': 'test/log_analyzer.log'
             })
 
@@ -66,6 +136,422 @@ class ConfigTest(unittest.TestCase):
         self.assertEqual(config.SCRIPT_LOG_PATH, 'test/log_analyzer.log')
 
 
+class ParseLineTest(unittest.TestCase):
+    def test_same_as_regex(self):
+        with gzip.open('test/log/nginx-access-ui.log-20170630.gz', 'rt') as log_file:
+            lines = log_file.readlines()
+        lines.extend([
+            '1.2.3.4 -  - [29/Jun/2017:03:59:15 +0300] "GET /api/1/?a=1 HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.001\n',
+            '1.2.3.4 -  - [29/Jun/2017:03:59:15 +0300] "GET  /api/1/ HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.001\n',
+            '1.2.3.4 -  - [29/Jun/2017:03:59:15 +0300] "GET /api/1/" 200 1 "-" "-" "-" "-" "-" 0.001\n',
+            '1.2.3.4 -  - [29/Jun/2017:03:59:15 +0300] "GET /api/1/ HTTP/1.1" 200 1 "-" "-" "-" "-" "-" -\n',
+            '] "GET /api/1/ HTTP/1.1" 0.001\n',
+            '\n',
+        ])
+        for line in lines:
+            self.assertEqual(log_analyzer.parse_line(line[:-1].encode()), log_analyzer.parse_line_regex(line), line)
+
+    def test_crlf(self):
+        line = b'1.2.3.4 -  - [29/Jun/2017:03:59:15 +0300] "GET /api/1/ HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.001\r'
+        self.assertEqual(log_analyzer.parse_line(line), log_analyzer.LogRecord('/api/1/', 0.001))
+
+
+class ReadLogTest(unittest.TestCase):
+    def test_split_lines(self):
+        chunks = [b'a\nb', b'c\n', b'', b'\nd\ne', b'f']
+        self.assertListEqual(list(log_analyzer.split_lines(chunks)), [b'a', b'bc', b'', b'd', b'ef'])
+
+    def test_read_chunks(self):
+        log_path = pathlib.Path('test/log/nginx-access-ui.log-20170630.gz')
+        with gzip.open(str(log_path), 'rb') as log_file:
+            data = log_file.read()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            multi_member_path = pathlib.Path(tmp_dir) / 'log.gz'
+            multi_member_path.write_bytes(gzip.compress(data[:1000]) + gzip.compress(data[1000:]))
+            self.assertEqual(b''.join(log_analyzer.read_gz_chunks(multi_member_path)), data)
+
+            truncated_path = pathlib.Path(tmp_dir) / 'truncated.gz'
+            truncated_path.write_bytes(log_path.read_bytes()[:-10])
+            with self.assertRaises(EOFError):
+                b''.join(log_analyzer.read_gz_chunks(truncated_path))
+
+            plain_path = pathlib.Path(tmp_dir) / 'log'
+            plain_path.write_bytes(data)
+            self.assertEqual(b''.join(log_analyzer.read_plain_chunks(plain_path)), data)
+            self.assertEqual(b''.join(log_analyzer.read_plain_chunks(plain_path, 100, 1000)), data[100:1000])
+
+            empty_path = pathlib.Path(tmp_dir) / 'empty'
+            empty_path.write_bytes(b'')
+            self.assertEqual(b''.join(log_analyzer.read_plain_chunks(empty_path)), b'')
+
+        self.assertEqual(b''.join(log_analyzer.read_gz_chunks(log_path)), data)
+        if log_analyzer.shutil.which('gzip') is not None:
+            self.assertEqual(b''.join(log_analyzer.read_gz_chunks_external(['gzip', '-dc'], log_path)), data)
+
+
+class ParseErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.config = log_analyzer.Config('test/config.json')
+        self.config.config.update(PARSE_ERROR_RATE=0.1, PARSE_ERROR_WARMUP=1000, PARSE_ERROR_SAMPLES=5)
+
+    def make_lines(self, error_rate, seed):
+        rnd = random.Random(seed)
+        for n in itertools.count():
+            if rnd.random() < error_rate:
+                yield 'broken line {:d}'.format(n).encode()
+            else:
+                yield b'1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 0 "-" 0.390'
+
+    def test_early_abort(self):
+        parse_stat = log_analyzer.make_parse_stat(self.config)
+        with self.assertRaisesRegex(Exception, 'Too many unparsed lines'):
+            for _ in log_analyzer.parse_lines(self.make_lines(0.5, 1), parse_stat):
+                pass
+        # rate is checked on unparsed line, the first one after warmup
+        self.assertGreaterEqual(parse_stat.line_count, 1000)
+        self.assertLess(parse_stat.line_count, 1100)
+        self.assertEqual(len(parse_stat.error_lines), 5)
+        self.assertTrue(all(line.startswith(b'broken line ') for line in parse_stat.error_lines))
+
+    def test_no_abort_near_rate(self):
+        parse_stat = log_analyzer.make_parse_stat(self.config)
+        records = list(log_analyzer.parse_lines(itertools.islice(self.make_lines(0.1, 2), 50000), parse_stat))
+        self.assertEqual(parse_stat.line_count, 50000)
+        self.assertEqual(len(records) + parse_stat.error_count, 50000)
+
+    def test_early_abort_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_file_path = benchmark.generate_log(tmp_dir, 20000, 50, 0.5, datetime.datetime(2017, 7, 1), False, 1)
+            log_info = log_analyzer.LogInfo(log_file_path, datetime.datetime(2017, 7, 1), False)
+            self.config.config.update(PARSE_WORKERS=2, PARSE_CHUNK_SIZE=64 * 1024)
+            parse_stat = log_analyzer.ParseStat()
+            with self.assertRaisesRegex(Exception, 'Too many unparsed lines: \\d+ errors in first \\d+ lines'):
+                log_analyzer.process_log(self.config, log_info, parse_stat)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_metrics(self):
+        log_info = log_analyzer.LogInfo(
+            pathlib.Path('test/log/nginx-access-ui.log-20170630.gz'), datetime.datetime(2017, 6, 30), True)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = log_analyzer.Config('test/config.json')
+            config.config.update(PROGRESS_INTERVAL=0, METRICS_PATH=str(pathlib.Path(tmp_dir) / 'metrics.json'))
+            metrics = log_analyzer.Metrics(config)
+
+            with self.assertLogs(level='INFO') as logs:
+                with metrics.stage('collect'):
+                    urls_info = log_analyzer.process_log(config, log_info, metrics.parse_stat)
+            self.assertTrue(any('Progress: ' in message for message in logs.output))
+            metrics.url_count = len(urls_info.info)
+            metrics.success = True
+            metrics.save()
+
+            metrics_json = json.loads(pathlib.Path(config.METRICS_PATH).read_text())
+            self.assertTrue(metrics_json['success'])
+            self.assertEqual(metrics_json['line_count'], 22)
+            self.assertEqual(metrics_json['error_count'], 2)
+            self.assertEqual(metrics_json['url_count'], 2)
+            self.assertEqual(metrics_json['file_bytes'], log_info.file_path.stat().st_size)
+            self.assertGreater(metrics_json['data_bytes'], metrics_json['file_bytes'])
+            self.assertGreater(metrics_json['peak_rss_bytes'], 0)
+            self.assertGreater(metrics_json['lines_per_sec'], 0)
+            self.assertSetEqual(set(metrics_json['stages']['collect']), {'wall_time', 'cpu_time'})
+
+            config.config.update(METRICS_FORMAT='prometheus', METRICS_PATH=str(pathlib.Path(tmp_dir) / 'metrics.prom'))
+            metrics.save()
+            metrics_text = pathlib.Path(config.METRICS_PATH).read_text()
+            self.assertIn('log_analyzer_line_count 22.0\n', metrics_text)
+            self.assertIn('log_analyzer_stage_wall_time{stage="collect"} ', metrics_text)
+
+    def test_progress_total(self):
+        log_info = log_analyzer.LogInfo(
+            pathlib.Path('test/log/nginx-access-ui.log-20170630.gz'), datetime.datetime(2017, 6, 30), True)
+        config = log_analyzer.Config('test/config.json')
+        config.config.update(PROGRESS_INTERVAL=0)
+        metrics = log_analyzer.Metrics(config)
+        with self.assertLogs(level='INFO'):
+            log_analyzer.process_log(config, log_info, metrics.parse_stat)
+
+        # progress of second log includes lines of the first one
+        with self.assertLogs(level='INFO') as logs:
+            log_analyzer.process_log(config, log_info, metrics.parse_stat)
+        line_counts = [int(message.split('Progress: ')[1].split()[0]) for message in logs.output if 'Progress: ' in message]
+        self.assertGreaterEqual(min(line_counts), 22)
+        self.assertEqual(line_counts[-1], 44)
+
+    def test_parallel_parse_stat(self):
+        log_info = log_analyzer.LogInfo(
+            pathlib.Path('test/log/nginx-access-ui.log-20170630.gz'), datetime.datetime(2017, 6, 30), True)
+        config = log_analyzer.Config('test/config.json')
+        config.config.update(PARSE_WORKERS=2, PARSE_BATCH_LINES=5)
+        progress_threads = set()
+        parse_stat = log_analyzer.ParseStat(progress=lambda _: progress_threads.add(threading.get_ident()))
+        log_analyzer.process_log(config, log_info, parse_stat)
+        self.assertEqual(parse_stat.line_count, 22)
+        self.assertEqual(parse_stat.error_count, 2)
+        self.assertEqual(parse_stat.file_size, log_info.file_path.stat().st_size)
+        with gzip.open(str(log_info.file_path), 'rb') as log_file:
+            self.assertEqual(parse_stat.data_size, len(log_file.read()))
+        # progress is reported only from main thread
+        self.assertSetEqual(progress_threads, {threading.get_ident()})
+
+
+class FollowTest(unittest.TestCase):
+    def test_follow(self):
+        with gzip.open('test/log/nginx-access-ui.log-20170630.gz', 'rb') as log_file:
+            lines = log_file.read().splitlines(keepends=True)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = log_analyzer.Config('test/config.json')
+            config.config.update(REPORT_DIR=tmp_dir, LOG_DIR=tmp_dir, REPORT_SIZE=10, FOLLOW_LINES=12)
+            log_path = pathlib.Path(tmp_dir) / 'nginx-access-ui.log'
+            follower = log_analyzer.LogFollower(config)
+            self.assertEqual(follower.report_file_path, pathlib.Path(tmp_dir) / 'report-live.json')
+
+            self.assertFalse(follower.read())
+            self.assertFalse(follower.need_render())
+
+            log_path.write_bytes(b''.join(lines[:10]) + lines[10][:20])
+            self.assertTrue(follower.read())
+            self.assertEqual(follower.parse_stat.line_count, 10)
+            self.assertFalse(follower.need_render())
+            follower.render()
+            report_json = json.loads(follower.report_file_path.read_text())
+            self.assertEqual(report_json[0]['count'], 10)
+
+            with open(str(log_path), 'ab') as log_file:
+                log_file.write(lines[10][20:] + b''.join(lines[11:]))
+            self.assertTrue(follower.read())
+            self.assertEqual(follower.parse_stat.line_count, len(lines))
+            self.assertEqual(follower.parse_stat.error_count, 2)
+            self.assertTrue(follower.need_render())
+            follower.render()
+            report_json = json.loads(follower.report_file_path.read_text())
+            self.assertEqual(report_json[0]['url'], '/api/v2/banner/26647998')
+            self.assertEqual(report_json[0]['count'], 10)
+            self.assertEqual(report_json[1]['count'], 10)
+            # running time sums give the same report as summing all process times
+            self.assertEqual(report_json, json.loads(json.dumps(
+                log_analyzer.make_report_info(config, follower.urls_info))))
+            self.assertFalse(follower.read())
+
+            # lines appended to old file after last read are read before rotation,
+            # incomplete last line too
+            with open(str(log_path), 'ab') as log_file:
+                log_file.write(b''.join(lines[:9]) + lines[9].rstrip(b'\n'))
+            drained_count = sum(1 for _ in log_analyzer.parse_lines(
+                [line.rstrip(b'\n') for line in lines[:10]], log_analyzer.ParseStat()))
+            total_count = follower.urls_info.count + drained_count
+            log_path.rename(log_path.with_name('nginx-access-ui.log-20170630'))
+            log_path.write_bytes(b''.join(lines[:3]))
+            self.assertTrue(follower.read())
+            report_json = json.loads(follower.report_file_path.read_text())
+            self.assertEqual(round(report_json[0]['count'] * 100 / report_json[0]['count_perc']), total_count)
+            self.assertEqual(follower.parse_stat.line_count, 3)
+            self.assertEqual(follower.urls_info.count, 3)
+            follower.log_tail.close()
+
+    def test_follow_errors(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = log_analyzer.Config('test/config.json')
+            config.config.update(REPORT_DIR=tmp_dir, LOG_DIR=tmp_dir, PARSE_ERROR_RATE=0.01)
+            log_path = pathlib.Path(tmp_dir) / 'nginx-access-ui.log'
+            with gzip.open('test/log/nginx-access-ui.log-20170630.gz', 'rb') as log_file:
+                lines = [line for line in log_file.read().splitlines(keepends=True)
+                         if log_analyzer.parse_line(line.rstrip(b'\n')) is not None]
+            log_path.write_bytes(b'broken line\n' + b''.join(lines * 2))
+            follower = log_analyzer.LogFollower(config)
+            # one broken line early in log does not stop follower before warmup
+            self.assertTrue(follower.read())
+            follower.render()
+            self.assertEqual(follower.parse_stat.error_count, 1)
+
+            config.config.update(PARSE_ERROR_WARMUP=1)
+            follower.error_monitor = log_analyzer.ErrorRateMonitor(config)
+            with open(str(log_path), 'ab') as log_file:
+                log_file.write(b'broken line\n' * 20)
+            self.assertTrue(follower.read())
+            with self.assertLogs(level='ERROR'):
+                follower.render()
+            self.assertTrue(follower.report_file_path.is_file())
+            follower.log_tail.close()
+
+
+class LogIndexTest(unittest.TestCase):
+    def test_log_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_dir_path = pathlib.Path(tmp_dir) / 'log'
+            log_dir_path.mkdir()
+            for name in ('nginx-access-ui.log-20170628.gz', 'nginx-access-ui.log-20170630',
+                         'nginx-access-ui.log-20170630.gz', 'nginx-access-ui.log-20170702.bz2',
+                         'nginx-access-ui.log', 'other-service.log-20170703'):
+                (log_dir_path / name).write_bytes(b'')
+            (log_dir_path / 'nginx-access-ui.log-20170701').mkdir()
+
+            config = log_analyzer.Config('test/config.json')
+            config.config.update(LOG_DIR=str(log_dir_path), LOG_INDEX_PATH=str(pathlib.Path(tmp_dir) / 'index.json'))
+            log_index = log_analyzer.LogIndex(config)
+            self.assertTrue(log_index.scanned)
+            self.assertListEqual(list(log_index.iterate_logs()), [
+                log_analyzer.LogInfo(log_dir_path / 'nginx-access-ui.log-20170628.gz',
+                                     datetime.datetime(2017, 6, 28), True),
+                log_analyzer.LogInfo(log_dir_path / 'nginx-access-ui.log-20170630',
+                                     datetime.datetime(2017, 6, 30), False),
+            ])
+            self.assertEqual(log_index.find_last_log().date, datetime.datetime(2017, 6, 30))
+            self.assertListEqual(
+                [log_info.date for log_info in log_index.find_logs(datetime.datetime(2017, 6, 29))],
+                [datetime.datetime(2017, 6, 30)])
+            self.assertListEqual(log_index.find_logs(None, datetime.datetime(2017, 6, 27)), [])
+
+            log_index.mark_processed([log_index.find_last_log()])
+            self.assertListEqual(log_index.find_unprocessed_logs(), [log_index.find_logs()[0]])
+            log_index.save()
+
+            # directory modified just now is scanned again
+            log_index = log_analyzer.LogIndex(config)
+            self.assertTrue(log_index.scanned)
+            self.assertListEqual(log_index.find_unprocessed_logs(), [log_index.find_logs()[0]])
+
+            old_time = time.time() - 60
+            os.utime(str(log_dir_path), (old_time, old_time))
+            log_analyzer.LogIndex(config).save()
+            log_index = log_analyzer.LogIndex(config)
+            self.assertFalse(log_index.scanned)
+            self.assertEqual(log_index.find_last_log().date, datetime.datetime(2017, 6, 30))
+
+            (log_dir_path / 'nginx-access-ui.log-20170705').write_bytes(b'')
+            log_index = log_analyzer.LogIndex(config)
+            self.assertTrue(log_index.scanned)
+            self.assertEqual(log_index.find_last_log().date, datetime.datetime(2017, 7, 5))
+            self.assertEqual(len(log_index.find_unprocessed_logs()), 2)
+
+    def test_unprocessed_reports(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_dir_path = pathlib.Path(tmp_dir) / 'log'
+            report_dir_path = pathlib.Path(tmp_dir) / 'report'
+            log_dir_path.mkdir()
+            report_dir_path.mkdir()
+            log_bytes = pathlib.Path('test/log/nginx-access-ui.log-20170630.gz').read_bytes()
+            for date in ('20170628', '20170629', '20170630'):
+                (log_dir_path / ('nginx-access-ui.log-' + date + '.gz')).write_bytes(log_bytes)
+            config = log_analyzer.Config('test/config.json')
+            config.config.update(LOG_DIR=str(log_dir_path), REPORT_DIR=str(report_dir_path),
+                                 LOG_INDEX_PATH=str(pathlib.Path(tmp_dir) / 'index.json'), PARSE_WORKERS=1)
+            args = argparse.Namespace(force=False)
+
+            # range report does not mark logs processed
+            log_analyzer.make_range_report(config, argparse.Namespace(
+                force=False, days=3, date_from=None, date_to=None), log_analyzer.Metrics(config))
+            self.assertEqual(len(log_analyzer.LogIndex(config).find_unprocessed_logs()), 3)
+
+            log_analyzer.make_last_report(config, args, log_analyzer.Metrics(config))
+            self.assertListEqual(sorted(path.name for path in report_dir_path.glob('report-*')),
+                                 ['report-2017.06.28-2017.06.30.json', 'report-2017.06.30.json'])
+            log_analyzer.make_unprocessed_reports(config, args, log_analyzer.Metrics(config))
+            self.assertListEqual(sorted(path.name for path in report_dir_path.glob('report-*')), [
+                'report-2017.06.28-2017.06.30.json', 'report-2017.06.28.json', 'report-2017.06.29.json',
+                'report-2017.06.30.json'])
+            self.assertListEqual(log_analyzer.LogIndex(config).find_unprocessed_logs(), [])
+
+
+class NormalizeUrlTest(unittest.TestCase):
+    def test_no_normalization(self):
+        config = log_analyzer.Config('test/config.json')
+        self.assertIsNone(log_analyzer.make_url_normalizer(config))
+
+    def test_normalize_url(self):
+        config = log_analyzer.Config('test/config.json')
+        config.config.update(URL_COLLAPSE_IDS=True)
+        normalize_url = log_analyzer.make_url_normalizer(config)
+        self.assertEqual(normalize_url('/api/v2/banner/26647998'), '/api/v2/banner/{id}')
+        self.assertEqual(normalize_url('/api/v2/banner/26647998/stat/?id=12'), '/api/v2/banner/{id}/stat/?id=12')
+        self.assertEqual(normalize_url('/api/1/2/v2'), '/api/{id}/{id}/v2')
+        self.assertEqual(
+            normalize_url('/export/0a1b2c3d-1111-2222-3333-444455556666/'), '/export/{uuid}/')
+        self.assertEqual(normalize_url('/api/v2/banner2'), '/api/v2/banner2')
+
+        config.config.update(URL_DROP_QUERY=True, URL_REWRITE_RULES=[['^/api/v\\d+/', '/api/']])
+        normalize_url = log_analyzer.make_url_normalizer(config)
+        self.assertEqual(normalize_url('/api/v2/banner/26647998/stat/?id=12'), '/api/banner/{id}/stat/')
+
+    def test_max_count(self):
+        config = log_analyzer.Config('test/config.json')
+        config.config.update(URL_MAX_COUNT=2)
+        parsed = [
+            log_analyzer.LogRecord('/a', 1.0),
+            log_analyzer.LogRecord('/b', 2.0),
+            log_analyzer.LogRecord('/c', 3.0),
+            log_analyzer.LogRecord('/a', 4.0),
+            log_analyzer.LogRecord('/d', 5.0)
+        ]
+        collected = log_analyzer.collect_url_info(config, parsed)
+        self.assertDictEqual(collected.info, {
+            '/a': array.array('d', [1.0, 4.0]),
+            '/b': array.array('d', [2.0]),
+            '__other__': array.array('d', [3.0, 5.0])
+        })
+        self.assertEqual(collected.count, 5)
+
+        merged = log_analyzer.merge_urls_info(config, [
+            log_analyzer.collect_url_info(config, parsed[3:]),
+            log_analyzer.collect_url_info(config, parsed[:3])
+        ])
+        self.assertDictEqual(merged.info, {
+            '/a': array.array('d', [4.0, 1.0]),
+            '/d': array.array('d', [5.0]),
+            '__other__': array.array('d', [2.0, 3.0])
+        })
+
+
+class UrlSketchTest(unittest.TestCase):
+    def test_median(self):
+        rnd = random.Random(1)
+        process_times = [round(rnd.expovariate(1.0), 3) for _ in range(10001)]
+        sorted_process_times = sorted(process_times)
+
+        for relative_error in (0.01, 0.05):
+            sketch = log_analyzer.UrlSketch(relative_error, 1024)
+            for process_time in process_times:
+                sketch.add(process_time)
+
+            self.assertEqual(sketch.count, len(process_times))
+            self.assertAlmostEqual(sketch.time_sum, sum(process_times))
+            self.assertEqual(sketch.time_max, max(process_times))
+            for rank in (100, 5000, 9900):
+                self.assertAlmostEqual(
+                    sketch.quantile(rank), sorted_process_times[rank], delta=sorted_process_times[rank] * relative_error)
+
+    def test_merge(self):
+        rnd = random.Random(2)
+        process_times = [round(rnd.expovariate(1.0), 3) for _ in range(1000)]
+
+        sketch = log_analyzer.UrlSketch(0.01, 1024)
+        for process_time in process_times:
+            sketch.add(process_time)
+
+        merged = log_analyzer.UrlSketch(0.01, 1024)
+        for start in range(0, len(process_times), 100):
+            part = log_analyzer.UrlSketch(0.01, 1024)
+            for process_time in process_times[start:start + 100]:
+                part.add(process_time)
+            merged.merge(part)
+
+        self.assertEqual(merged.count, sketch.count)
+        self.assertEqual(merged.zero_count, sketch.zero_count)
+        self.assertDictEqual(merged.buckets, sketch.buckets)
+        self.assertEqual(merged.median(), sketch.median())
+
+    def test_collapse(self):
+        sketch = log_analyzer.UrlSketch(0.01, 16)
+        for n in range(1, 1000):
+            sketch.add(n / 100)
+        self.assertEqual(len(sketch.buckets), 16)
+        self.assertEqual(sketch.count, 999)
+        self.assertAlmostEqual(sketch.quantile(998), 9.99, delta=9.99 * 0.01)
+
+
 class ProcessingTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -95,8 +581,8 @@ class ProcessingTest(unittest.TestCase):
             log_analyzer.LogRecord('/api/v2/banner/26619125', 1.171)
         ]
         cls.collected = log_analyzer.UrlsInfo({
-            '/api/v2/banner/26619125': [1.101, 0.308, 0.479, 1.287, 2.023, 0.913, 0.34, 0.226, 1.45, 1.171],
-            '/api/v2/banner/26647998': [2.714, 3.342, 0.894, 1.555, 1.24, 1.726, 1.093, 2.195, 0.539, 1.262]
+            '/api/v2/banner/26619125': array.array('d', [1.101, 0.308, 0.479, 1.287, 2.023, 0.913, 0.34, 0.226, 1.45, 1.171]),
+            '/api/v2/banner/26647998': array.array('d', [2.714, 3.342, 0.894, 1.555, 1.24, 1.726, 1.093, 2.195, 0.539, 1.262])
         }, 20, 25.858)
         cls.report = [{
             'time_med': 1.555,
@@ -136,6 +622,125 @@ class ProcessingTest(unittest.TestCase):
         self.assertEqual(collected.count, self.collected.count)
         self.assertAlmostEqual(collected.time_sum, self.collected.time_sum)
 
+    def test_process_log(self):
+        collected = log_analyzer.process_log(self.config, self.log_info)
+        self.assertEqual(collected, log_analyzer.collect_url_info(self.config, self.parsed))
+
+    def test_process_log_parallel(self):
+        config = log_analyzer.Config('test/config.json')
+        config.config.update(PARSE_WORKERS=2, PARSE_BATCH_LINES=5, PARSE_CHUNK_SIZE=1024)
+        serial = log_analyzer.process_log(self.config, self.log_info)
+
+        collected = log_analyzer.process_log(config, self.log_info)
+        self.assertEqual(collected, serial)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            plain_log_path = pathlib.Path(tmp_dir) / 'nginx-access-ui.log-20170630'
+            with gzip.open(str(self.log_info.file_path), 'rb') as log_file:
+                plain_log_path.write_bytes(log_file.read())
+            plain_log_info = log_analyzer.LogInfo(plain_log_path, self.log_info.date, False)
+            self.assertGreater(len(log_analyzer.find_line_boundaries(config, plain_log_info)), 2)
+
+            collected = log_analyzer.process_log(config, plain_log_info)
+            self.assertEqual(collected, serial)
+
+    def test_aggregate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = log_analyzer.Config('test/config.json')
+            config.config.update(REPORT_DIR=tmp_dir)
+            log_path = pathlib.Path(tmp_dir) / self.log_info.file_path.name
+            log_path.write_bytes(self.log_info.file_path.read_bytes())
+            log_info = self.log_info._replace(file_path=log_path)
+
+            self.assertIsNone(log_analyzer.load_aggregate(config, log_info))
+            collected = log_analyzer.process_log(config, log_info)
+            log_analyzer.save_aggregate(config, log_info, collected)
+            self.assertTrue(log_analyzer.make_aggregate_file_path(config, log_info).is_file())
+            self.assertEqual(log_analyzer.load_aggregate(config, log_info), collected)
+
+            config.config.update(AGGREGATION='sketch')
+            self.assertIsNone(log_analyzer.load_aggregate(config, log_info))
+            config.config.update(AGGREGATION='exact')
+            self.assertEqual(log_analyzer.load_aggregate(config, log_info), collected)
+
+            with open(str(log_path), 'ab') as log_file:
+                log_file.write(b'\0')
+            self.assertIsNone(log_analyzer.load_aggregate(config, log_info))
+
+    def test_collect_logs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = log_analyzer.Config('test/config.json')
+            config.config.update(REPORT_DIR=tmp_dir, LOG_DIR=tmp_dir, PARSE_WORKERS=2)
+            log_data = self.log_info.file_path.read_bytes()
+            for name in ('nginx-access-ui.log-20170628.gz', 'nginx-access-ui.log-20170629.gz',
+                         'nginx-access-ui.log-20170701.gz', 'nginx-access-ui.log-20170702.gz'):
+                (pathlib.Path(tmp_dir) / name).write_bytes(log_data)
+
+            log_infos = log_analyzer.find_logs(
+                config, datetime.datetime(2017, 6, 29), datetime.datetime(2017, 7, 1))
+            self.assertListEqual([log_info.date for log_info in log_infos],
+                                 [datetime.datetime(2017, 6, 29), datetime.datetime(2017, 7, 1)])
+            self.assertEqual(
+                log_analyzer.make_range_report_file_path(config, log_infos),
+                pathlib.Path(tmp_dir) / 'report-2017.06.29-2017.07.01.json')
+
+            single = log_analyzer.process_log(config, self.log_info)
+            expected = log_analyzer.merge_urls_info(config, [single, single])
+            log_analyzer.save_aggregate(config, log_infos[0], single)
+
+            collected = log_analyzer.collect_logs(config, log_infos)
+            self.assertEqual(collected, expected)
+            self.assertEqual(collected.count, 2 * single.count)
+            self.assertEqual(log_analyzer.load_aggregate(config, log_infos[1]), single)
+
+    def test_select_top_urls(self):
+        config = log_analyzer.Config('test/config.json')
+        config.config.update(REPORT_SIZE=50)
+        rnd = random.Random(3)
+        info = {}
+        for n in range(200):
+            info['/url/{:d}'.format(n)] = array.array('d', [rnd.choice([0.5, 1.0, 1.5]) for _ in range(rnd.randint(1, 3))])
+        urls_info = log_analyzer.make_urls_info(config, info)
+
+        top_urls = log_analyzer.select_top_urls(config, urls_info)
+        expected = sorted(((url, sum(process_times)) for url, process_times in info.items()),
+                          key=lambda item: item[1], reverse=True)[:50]
+        self.assertListEqual(top_urls, expected)
+        url_time_sums = {url: math.fsum(process_times) for url, process_times in info.items()}
+        self.assertListEqual(log_analyzer.select_top_urls(config, urls_info, url_time_sums), expected)
+
+    def test_select_median(self):
+        rnd = random.Random(5)
+        for size in (1, 2, 3, 10, 101, 1000, 1001, 5000, 20000):
+            process_times = array.array('d', [rnd.choice([0.1, 0.2, round(rnd.random(), 2)]) for _ in range(size)])
+            self.assertEqual(log_analyzer.select_median(process_times), sorted(process_times)[size // 2])
+        process_times = array.array('d', [0.5] * 3000 + [1.0] * 3001)
+        self.assertEqual(log_analyzer.select_median(process_times), 1.0)
+
+    def test_make_report_info_time_sum(self):
+        # sequential sum of ten 0.1 is 0.9999999999999999, math.fsum gives 1.0,
+        # so '/tenth' ties with '/one' and stays first as it came first in log
+        config = log_analyzer.Config('test/config.json')
+        config.config.update(REPORT_SIZE=2)
+        info = {'/tenth': array.array('d', [0.1] * 10), '/one': array.array('d', [1.0])}
+        report = log_analyzer.make_report_info(config, log_analyzer.make_urls_info(config, info))
+        self.assertListEqual([(record['url'], record['time_sum']) for record in report], [('/tenth', 1.0), ('/one', 1.0)])
+
+    def test_make_report_info_sketch(self):
+        config = log_analyzer.Config('test/config.json')
+        config.config.update(AGGREGATION='sketch')
+        collected = log_analyzer.collect_url_info(config, self.parsed)
+        self.assertEqual(collected.count, self.collected.count)
+        self.assertAlmostEqual(collected.time_sum, self.collected.time_sum)
+
+        report = log_analyzer.make_report_info(config, collected)
+        self.assertEqual(len(report), len(self.report))
+        self.assertAlmostEqual(report[0]['time_med'], self.report[0]['time_med'], delta=self.report[0]['time_med'] * 0.01)
+        self.assertAlmostEqual(report[0]['time_sum'], self.report[0]['time_sum'])
+        self.assertEqual(report[0]['count'], self.report[0]['count'])
+        self.assertEqual(report[0]['url'], self.report[0]['url'])
+        self.assertAlmostEqual(report[0]['time_max'], self.report[0]['time_max'])
+
     def test_make_report_info(self):
         report = log_analyzer.make_report_info(self.config, self.collected)
         self.assertEqual(len(report), len(self.report))
@@ -156,6 +761,22 @@ class ProcessingTest(unittest.TestCase):
         self.assertListEqual(report_json, self.report)
         report_json_path.unlink()
 
+    def test_render_report_template(self):
+        template_text = 'var a = $table_json;\n$$x ${table_json} $other ${other} $ $$table_json\n$table_json'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = log_analyzer.Config('test/config.json')
+            config.config.update(REPORT_TEMPLATE=str(pathlib.Path(tmp_dir) / 'report.html'))
+            pathlib.Path(config.REPORT_TEMPLATE).write_text(template_text)
+            report_file_path = pathlib.Path(tmp_dir) / 'report-2017.06.30.html'
+            cache_hits = log_analyzer.load_template.cache_info().hits
+            for report_info in (self.report, self.report * 3, []):
+                log_analyzer.render_report(config, report_file_path, report_info)
+                self.assertEqual(
+                    report_file_path.read_text(),
+                    log_analyzer.Template(template_text).safe_substitute(table_json=json.dumps(report_info)))
+            # template is parsed once for all renders
+            self.assertEqual(log_analyzer.load_template.cache_info().hits, cache_hits + 2)
+
 
 if __name__ == '__main__':
     unittest.main()
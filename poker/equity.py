@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Эквити игроков в холдеме: у каждого игрока карты на руках или диапазон
+# рук, часть борда может быть уже открыта. Оставшиеся карты перебираются
+# полностью, если вариантов немного, иначе раздаются случайно (Монте-Карло)
+# пачками в пуле процессов, у каждой пачки свой seed. Раздачи прекращаются,
+# когда доверительный интервал эквити становится достаточно узким.
+# -----------------
+
+import argparse
+import collections
+import functools
+import itertools
+import math
+import multiprocessing
+import random
+import statistics
+
+import poker
+
+BOARD_SIZE = 5
+BATCH_TRIALS = 10000
+EXHAUSTIVE_LIMIT = 200000
+MAX_DEAL_ATTEMPTS = 1000
+
+Equity = collections.namedtuple('Equity', 'win tie loss equity')
+SimulationResult = collections.namedtuple('SimulationResult', 'equities trials exhaustive error')
+
+
+def parse_cards(cards):
+    """Возвращает индексы карт, заданных строкой 'AS KD' или списком"""
+    if isinstance(cards, str):
+        cards = cards.split()
+    return [poker.CARD_INDEX[c] for c in cards]
+
+
+def parse_range(spec):
+    """
+    Возвращает руки диапазона, заданного через запятую картами ('AS KD') или
+    рангами: 'QQ' - пара, 'AKs' - одномастные, 'AKo' - разномастные, 'AK' - любые
+    """
+    hands = []
+    for token in spec.split(','):
+        token = token.strip()
+        if ' ' in token:
+            hand = parse_cards(token)
+            if len(hand) != 2 or hand[0] == hand[1]:
+                raise ValueError('Wrong hand: {}'.format(token))
+            hands.append(tuple(sorted(hand)))
+            continue
+        if len(token) not in (2, 3) or token[0] not in poker.RANK_PRIORITIES or token[1] not in poker.RANK_PRIORITIES:
+            raise ValueError('Wrong range: {}'.format(token))
+        suited = token[2:]
+        if suited not in ('', 's', 'o'):
+            raise ValueError('Wrong range: {}'.format(token))
+        r1 = poker.RANK_PRIORITIES[token[0]]
+        r2 = poker.RANK_PRIORITIES[token[1]]
+        for s1, s2 in itertools.product(range(0, 4), repeat=2):
+            if (r1 == r2 and s1 >= s2) or (suited == 's' and s1 != s2) or (suited == 'o' and s1 == s2):
+                continue
+            hands.append(tuple(sorted((r1 * 4 + s1, r2 * 4 + s2))))
+    if not hands:
+        raise ValueError('Empty range: {}'.format(spec))
+    return list(dict.fromkeys(hands))
+
+
+class EquityStats:
+    """Число раздач, побед, ничьих и суммы долей банка игроков"""
+
+    def __init__(self, player_count):
+        self.trials = 0
+        self.wins = [0] * player_count
+        self.ties = [0] * player_count
+        self.shares = [0.0] * player_count
+        self.squares = [0.0] * player_count
+
+    def add(self, values):
+        best = max(values)
+        winners = [n for n in range(0, len(values)) if values[n] == best]
+        share = 1.0 / len(winners)
+        self.trials += 1
+        for n in winners:
+            if len(winners) == 1:
+                self.wins[n] += 1
+            else:
+                self.ties[n] += 1
+            self.shares[n] += share
+            self.squares[n] += share * share
+
+    def update(self, stats):
+        self.trials += stats.trials
+        for n in range(0, len(self.wins)):
+            self.wins[n] += stats.wins[n]
+            self.ties[n] += stats.ties[n]
+            self.shares[n] += stats.shares[n]
+            self.squares[n] += stats.squares[n]
+
+    def get_error(self, z):
+        """Наибольшая по игрокам половина доверительного интервала эквити"""
+        if self.trials < 2:
+            return math.inf
+        error = 0.0
+        for shares, squares in zip(self.shares, self.squares):
+            mean = shares / self.trials
+            variance = max(0.0, squares / self.trials - mean * mean) * self.trials / (self.trials - 1)
+            error = max(error, z * math.sqrt(variance / self.trials))
+        return error
+
+    def make_equities(self):
+        return [
+            Equity(wins / self.trials, ties / self.trials, (self.trials - wins - ties) / self.trials,
+                   shares / self.trials)
+            for wins, ties, shares in zip(self.wins, self.ties, self.shares)
+        ]
+
+
+def deal_hands(rnd, ranges, dead):
+    """Случайные руки из диапазонов игроков без общих карт"""
+    for _ in range(0, MAX_DEAL_ATTEMPTS):
+        used = set(dead)
+        hands = []
+        for hands_range in ranges:
+            hand = rnd.choice(hands_range)
+            if hand[0] in used or hand[1] in used:
+                break
+            used.update(hand)
+            hands.append(hand)
+        else:
+            return hands
+    raise ValueError('Could not deal hands from ranges without common cards')
+
+
+def iterate_hands(ranges, board):
+    """Все сочетания рук из диапазонов игроков без общих карт"""
+    for hands in itertools.product(*ranges):
+        used = set(board)
+        for hand in hands:
+            if hand[0] in used or hand[1] in used:
+                break
+            used.update(hand)
+        else:
+            yield hands, used
+
+
+def iterate_deals(ranges, board):
+    """Все раздачи: руки игроков и дополнения борда до 5 карт"""
+    for hands, used in iterate_hands(ranges, board):
+        deck = [c for c in range(0, len(poker.CARD_LIST)) if c not in used]
+        for rest in itertools.combinations(deck, BOARD_SIZE - len(board)):
+            yield hands, board + list(rest)
+
+
+def count_deals(ranges, board):
+    return sum(math.comb(len(poker.CARD_LIST) - len(used), BOARD_SIZE - len(board))
+               for _, used in iterate_hands(ranges, board))
+
+
+def estimate_deals(ranges, board):
+    """Оценка сверху числа раздач без перебора рук"""
+    hand_count = 1
+    for hands_range in ranges:
+        hand_count *= len(hands_range)
+    return hand_count * math.comb(len(poker.CARD_LIST) - len(board) - 2 * len(ranges), BOARD_SIZE - len(board))
+
+
+def run_task(ranges, board, task):
+    """
+    Раздачи одной задачи пула: ('exhaustive', start, stop) - часть полного
+    перебора, ('random', trials, seed) - случайные раздачи
+    """
+    stats = EquityStats(len(ranges))
+    if task[0] == 'exhaustive':
+        for hands, full_board in itertools.islice(iterate_deals(ranges, board), task[1], task[2]):
+            stats.add([poker.evaluate_cards(list(hand) + full_board)[0] for hand in hands])
+    else:
+        rnd = random.Random(task[2])
+        for _ in range(0, task[1]):
+            hands = deal_hands(rnd, ranges, board)
+            used = set(board).union(*hands)
+            deck = [c for c in range(0, len(poker.CARD_LIST)) if c not in used]
+            full_board = board + rnd.sample(deck, BOARD_SIZE - len(board))
+            stats.add([poker.evaluate_cards(list(hand) + full_board)[0] for hand in hands])
+    return stats
+
+
+def collect_stats(stats, results, target_error, z):
+    """Складывает результаты задач по порядку, пока ошибка больше target_error"""
+    for part_stats in results:
+        stats.update(part_stats)
+        if target_error is not None and stats.get_error(z) <= target_error:
+            break
+
+
+def simulate(players, board='', trials=100000, seed=0, workers=1, target_error=None, confidence=0.95,
+             batch_trials=BATCH_TRIALS, exhaustive_limit=EXHAUSTIVE_LIMIT):
+    """
+    Эквити игроков, заданных диапазонами рук (см. parse_range), при борде
+    board. Если раздач не больше exhaustive_limit, они перебираются все,
+    иначе раздается trials случайных пачками по batch_trials. Пачка n
+    раздается с seed '{seed}-{n}' и результаты складываются по порядку,
+    поэтому они не зависят от числа процессов workers. Случайные раздачи
+    прекращаются, когда половина доверительного интервала с уровнем
+    confidence не больше target_error
+    """
+    board = parse_cards(board)
+    if len(board) > BOARD_SIZE or len(set(board)) < len(board):
+        raise ValueError('Wrong board')
+    ranges = []
+    for spec in players:
+        hands_range = [hand for hand in parse_range(spec) if hand[0] not in board and hand[1] not in board]
+        if not hands_range:
+            raise ValueError('All hands of range intersect with board: {}'.format(spec))
+        ranges.append(hands_range)
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+
+    exhaustive = estimate_deals(ranges, board) <= exhaustive_limit
+    if exhaustive:
+        deal_count = count_deals(ranges, board)
+        if deal_count == 0:
+            raise ValueError('Could not deal hands from ranges without common cards')
+        chunk = -(-deal_count // max(1, workers))
+        tasks = [('exhaustive', start, start + chunk) for start in range(0, deal_count, chunk)]
+        target_error = None
+    else:
+        tasks = (('random', min(batch_trials, trials - start), '{}-{}'.format(seed, n))
+                 for n, start in enumerate(range(0, trials, batch_trials)))
+
+    stats = EquityStats(len(ranges))
+    run = functools.partial(run_task, ranges, board)
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            collect_stats(stats, pool.imap(run, tasks), target_error, z)
+    else:
+        collect_stats(stats, map(run, tasks), target_error, z)
+
+    return SimulationResult(stats.make_equities(), stats.trials, exhaustive, 0.0 if exhaustive else stats.get_error(z))
+
+
+def test_parse_range():
+    print("test_parse_range...")
+    assert (len(parse_range('AA')) == 6)
+    assert (len(parse_range('AKs')) == 4)
+    assert (len(parse_range('AKo')) == 12)
+    assert (len(parse_range('AK, AKs')) == 16)
+    assert (parse_range('AS KD') == [tuple(sorted(parse_cards('AS KD')))])
+    print('OK')
+
+
+def test_exhaustive():
+    print("test_exhaustive...")
+    # на терне у AA против KK проигрывают только две оставшиеся K из 44 карт
+    result = simulate(['AS AD', 'KS KD'], '2C 7H 9S 3D')
+    assert (result.exhaustive and result.trials == 44)
+    assert (result.equities[1].win == 2 / 44 and result.equities[0].win == 42 / 44)
+    # одинаковые руки делят банк, если борд не дает флеша
+    result = simulate(['AS KS', 'AD KD'], '2C 7H 9C')
+    assert (result.exhaustive and abs(result.equities[0].equity - result.equities[1].equity) < 1e-12)
+    assert (result.equities[0].tie > 0.9)
+    print('OK')
+
+
+def test_random():
+    print("test_random...")
+    result = simulate(['AA', 'KK'], trials=20000, seed=1, batch_trials=5000)
+    assert (not result.exhaustive and result.trials == 20000)
+    assert (abs(result.equities[0].equity - 0.82) < 0.02)
+    assert (abs(sum(e.equity for e in result.equities) - 1) < 1e-9)
+    parallel = simulate(['AA', 'KK'], trials=20000, seed=1, batch_trials=5000, workers=2)
+    assert (parallel == result)
+    stopped = simulate(['AA', 'KK'], trials=1000000, seed=1, batch_trials=5000, target_error=0.01)
+    assert (stopped.trials < 1000000 and stopped.error <= 0.01)
+    print('OK')
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description="equity of holdem hands and ranges")
+    sub_parsers = args_parser.add_subparsers(dest='command')
+    sub_parsers.required = True
+
+    run_parser = sub_parsers.add_parser('run', help="compute equity of players")
+    run_parser.add_argument("players", help="hand like 'AS KD' or range like 'QQ,AKs,AKo'", nargs='+')
+    run_parser.add_argument("--board", help="known board cards like '2C 7H 9S'", type=str, default='')
+    run_parser.add_argument("--trials", help="maximal number of random deals", type=int, default=100000)
+    run_parser.add_argument("--seed", help="random seed", type=int, default=0)
+    run_parser.add_argument("--workers", help="number of processes", type=int, default=1)
+    run_parser.add_argument("--error", help="stop when confidence interval half-width is not greater",
+                            type=float, default=None)
+    run_parser.add_argument("--confidence", help="confidence level of interval", type=float, default=0.95)
+
+    sub_parsers.add_parser('test', help="run tests")
+
+    args = args_parser.parse_args()
+
+    if args.command == 'run':
+        result = simulate(args.players, args.board, args.trials, args.seed, args.workers, args.error, args.confidence)
+        for player, equity in zip(args.players, result.equities):
+            print('{}: equity {:.4f}, win {:.4f}, tie {:.4f}, loss {:.4f}'.format(
+                player, equity.equity, equity.win, equity.tie, equity.loss))
+        print('{} deals{}, error {:.4f}'.format(
+            result.trials, ' (exhaustive)' if result.exhaustive else '', result.error))
+
+    elif args.command == 'test':
+        test_parse_range()
+        test_exhaustive()
+        test_random()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Проверка и замеры оценщиков рук из poker.py: полный перебор всех рук из
+# 5 карт со сверкой числа рук каждой категории с известным распределением,
+# сравнение best_hand и best_wild_hand с эталонными реализациями на
+# случайных руках из 7 карт с джокерами и без, и число рук в секунду для
+# каждого оценщика.
+# -----------------
+
+import argparse
+import collections
+import itertools
+import random
+import time
+
+import poker
+
+HAND_COUNT = 2598960
+# число рук из 5 карт каждой категории
+CATEGORY_COUNTS = {
+    poker.STRAIGHT_FLUSH: 40,
+    poker.FOUR_OF_A_KIND: 624,
+    poker.FULL_HOUSE: 3744,
+    poker.FLUSH: 5108,
+    poker.STRAIGHT: 10200,
+    poker.THREE_OF_A_KIND: 54912,
+    poker.TWO_PAIR: 123552,
+    poker.PAIR: 1098240,
+    poker.HIGH_CARD: 1302540,
+}
+# число различных по силе рук из 5 карт
+DISTINCT_VALUE_COUNT = 7462
+CATEGORY_NAMES = ['high card', 'pair', 'two pair', 'three of a kind', 'straight', 'flush', 'full house',
+                  'four of a kind', 'straight flush']
+MISMATCH_EXAMPLES = 5
+
+# оценщики числа, определяющего ранг руки из 5 карт, заданных индексами
+ENUMERATE_EVALUATORS = {
+    'evaluate5': lambda cards: poker.evaluate5(*cards),
+    'evaluate_cards': lambda cards: poker.evaluate_cards(list(cards))[0],
+}
+
+Evaluator = collections.namedtuple('Evaluator', 'name hand_size jokers prepare evaluate batch')
+
+
+def count_categories(evaluator='evaluate5'):
+    """Перебирает все руки из 5 карт, возвращает число рук по категориям и число различных значений"""
+    evaluate = ENUMERATE_EVALUATORS[evaluator]
+    value_counts = collections.Counter(map(evaluate, itertools.combinations(range(0, len(poker.CARD_LIST)), 5)))
+    category_counts = collections.Counter()
+    for value, count in value_counts.items():
+        category_counts[value >> poker.CATEGORY_SHIFT] += count
+    return category_counts, len(value_counts)
+
+
+def check_categories(category_counts, value_count):
+    """Возвращает список расхождений с известным распределением"""
+    errors = []
+    for category, expected in sorted(CATEGORY_COUNTS.items(), reverse=True):
+        if category_counts[category] != expected:
+            errors.append('{}: {} hands, expected {}'.format(
+                CATEGORY_NAMES[category], category_counts[category], expected))
+    if sum(category_counts.values()) != HAND_COUNT:
+        errors.append('{} hands, expected {}'.format(sum(category_counts.values()), HAND_COUNT))
+    if value_count != DISTINCT_VALUE_COUNT:
+        errors.append('{} distinct values, expected {}'.format(value_count, DISTINCT_VALUE_COUNT))
+    return errors
+
+
+def deal_hand(rnd, jokers):
+    """Случайная рука из 7 карт, из них jokers джокеров: один случайного цвета или оба"""
+    joker_cards = [rnd.choice(['?B', '?R'])] if jokers == 1 else ['?B', '?R'][:jokers]
+    return rnd.sample(poker.CARD_LIST, 7 - jokers) + joker_cards
+
+
+def check_best(hand, best):
+    """Проверяет, что best - 5 разных карт руки, а карты не из руки могут заменить ее джокеры"""
+    if len(best) != 5 or len(set(best)) != 5:
+        return False
+    colours = collections.Counter(poker.JOKER_COLOURS[c] for c in hand if c in poker.JOKER_COLOURS)
+    for c in best:
+        if c in hand:
+            continue
+        colour = poker.SUIT_PRIORITIES[c[1]] >> 1
+        if c not in poker.CARD_INDEX or colours[colour] == 0:
+            return False
+        colours[colour] -= 1
+    return True
+
+
+def compare_hands(samples, jokers, seed):
+    """
+    Сравнивает ранги рук, которые выбирают best_hand, best_wild_hand, их
+    кэшируемые варианты и best_hand_batch, с выбором эталонной реализации
+    на samples случайных руках с jokers джокерами. Возвращает словарь
+    расхождений по оценщикам, в нем руки, на которых они найдены
+    """
+    rnd = random.Random(seed)
+    hands = [deal_hand(rnd, jokers) for _ in range(0, samples)]
+    if jokers:
+        reference = poker.best_wild_hand_reference
+        candidates = {
+            'best_wild_hand': poker.best_wild_hand,
+            'best_wild_hand_cached': poker.best_wild_hand_cached,
+        }
+    else:
+        reference = poker.best_hand_reference
+        candidates = {
+            'best_hand': poker.best_hand,
+            'best_hand_cached': poker.best_hand_cached,
+            'best_wild_hand': poker.best_wild_hand,
+        }
+    expected = [poker.hand_rank_reference(reference(hand)) for hand in hands]
+
+    mismatches = collections.defaultdict(list)
+    for name, best_func in candidates.items():
+        for hand, rank in zip(hands, expected):
+            best = best_func(hand)
+            if not check_best(hand, best) or poker.hand_rank(best) != rank:
+                mismatches[name].append(hand)
+    if poker.numpy is not None:
+        values = poker.best_hand_batch(poker.encode_hands(hands))[0]
+        for hand, rank, value in zip(hands, expected, values.tolist()):
+            if poker.value_to_rank(value) != rank:
+                mismatches['best_hand_batch'].append(hand)
+    return dict(mismatches)
+
+
+def make_evaluators():
+    """Оценщики для замеров: принимают руку после prepare, batch - сразу все руки"""
+    evaluators = [
+        Evaluator('hand_rank', 5, 0, list, poker.hand_rank, False),
+        Evaluator('hand_rank_reference', 5, 0, list, poker.hand_rank_reference, False),
+        Evaluator('evaluate5', 5, 0, poker.parse_hand, lambda cards: poker.evaluate5(*cards), False),
+        Evaluator('evaluate_cards', 7, 0, poker.parse_hand, poker.evaluate_cards, False),
+        Evaluator('evaluate_cards_cached', 7, 0, poker.parse_hand, poker.evaluate_cards_cached, False),
+        Evaluator('best_hand', 7, 0, list, poker.best_hand, False),
+        Evaluator('best_hand_cached', 7, 0, list, poker.best_hand_cached, False),
+        Evaluator('best_hand_reference', 7, 0, list, poker.best_hand_reference, False),
+    ]
+    for jokers in (1, 2):
+        evaluators += [
+            Evaluator('best_wild_hand', 7, jokers, list, poker.best_wild_hand, False),
+            Evaluator('best_wild_hand_cached', 7, jokers, list, poker.best_wild_hand_cached, False),
+            Evaluator('best_wild_hand_reference', 7, jokers, list, poker.best_wild_hand_reference, False),
+        ]
+    if poker.numpy is not None:
+        evaluators += [
+            Evaluator('best_hand_batch', 7, jokers, poker.encode_hands, poker.best_hand_batch, True)
+            for jokers in (0, 1, 2)
+        ]
+    return evaluators
+
+
+def bench_evaluator(evaluator, hands, min_time):
+    """
+    Число рук в секунду: руки оцениваются по одной, пока не пройдет min_time
+    секунд или не кончатся руки, пакетный оценщик получает сразу все
+    """
+    if evaluator.batch:
+        inputs = evaluator.prepare(hands)
+        start = time.perf_counter()
+        evaluator.evaluate(inputs)
+        return len(hands), len(hands) / (time.perf_counter() - start)
+    # карты руки в начале, джокеры в конце: оценщику 5 карт достаются первые 5
+    inputs = [evaluator.prepare(hand[:evaluator.hand_size]) for hand in hands]
+    evaluate = evaluator.evaluate
+    count = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while count < len(inputs) and elapsed < min_time:
+        # время проверяется после каждых 100 рук
+        for hand in inputs[count:count + 100]:
+            evaluate(hand)
+        count = min(len(inputs), count + 100)
+        elapsed = time.perf_counter() - start
+    return count, count / elapsed
+
+
+def bench(hand_count, min_time, seed, distinct=None, names=None):
+    """
+    Замеряет оценщики make_evaluators на одних и тех же случайных руках.
+    Если задано distinct, руки выбираются из distinct разных, так видна
+    работа кэша на повторяющихся руках. Возвращает список (оценщик, рук, рук/сек)
+    """
+    rnd = random.Random(seed)
+    results = []
+    for jokers in (0, 1, 2):
+        hands = [deal_hand(rnd, jokers) for _ in range(0, distinct or hand_count)]
+        if distinct:
+            hands = rnd.choices(hands, k=hand_count)
+        for evaluator in make_evaluators():
+            if evaluator.jokers != jokers or (names and evaluator.name not in names):
+                continue
+            if evaluator.name.endswith('_cached'):
+                poker.evaluate_canonical.cache_clear()
+            count, hands_per_sec = bench_evaluator(evaluator, hands, min_time)
+            results.append((evaluator, count, hands_per_sec))
+    return results
+
+
+def test_count_categories():
+    print("test_count_categories...")
+    category_counts, value_count = count_categories()
+    assert (not check_categories(category_counts, value_count)), check_categories(category_counts, value_count)
+    assert (check_categories(collections.Counter({poker.PAIR: HAND_COUNT}), 1))
+    print('OK')
+
+
+def test_compare_hands():
+    print("test_compare_hands...")
+    for jokers, samples in [(0, 200), (1, 50), (2, 20)]:
+        assert (not compare_hands(samples, jokers, 0)), jokers
+    assert (check_best("TD TC 5H 5C 7C ?R ?B".split(), ('TD', 'TC', '7C', 'TS', 'TH')))
+    assert (not check_best("TD TC 5H 5C 7C 8C ?B".split(), ('TD', 'TC', '7C', 'TS', 'TH')))
+    assert (not check_best("TD TC 5H 5C 7C 8C 9C".split(), ('TD', 'TC', '7C', '8C', '8C')))
+    print('OK')
+
+
+def test_bench():
+    print("test_bench...")
+    results = bench(200, 0.01, 0, names=['evaluate5', 'best_hand', 'best_wild_hand'])
+    assert ([(e.name, e.jokers) for e, _, _ in results] ==
+            [('evaluate5', 0), ('best_hand', 0), ('best_wild_hand', 1), ('best_wild_hand', 2)])
+    assert (all(count > 0 and hands_per_sec > 0 for _, count, hands_per_sec in results))
+    print('OK')
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description="correctness harness and benchmarks of poker hand evaluators")
+    sub_parsers = args_parser.add_subparsers(dest='command')
+    sub_parsers.required = True
+
+    enumerate_parser = sub_parsers.add_parser(
+        'enumerate', help="evaluate all 5-card hands and check counts of categories")
+    enumerate_parser.add_argument("--evaluator", help="evaluator to check", choices=sorted(ENUMERATE_EVALUATORS),
+                                  default='evaluate5')
+
+    compare_parser = sub_parsers.add_parser('compare', help="compare best hands with reference on random hands")
+    compare_parser.add_argument("--samples", help="number of random hands without jokers", type=int, default=10000)
+    # эталон с джокерами перебирает все замены во всех 5 картах из 7, до 0.1 сек на руку
+    compare_parser.add_argument("--wild-samples", help="number of random hands for every number of jokers",
+                                type=int, default=1000)
+    compare_parser.add_argument("--jokers", help="numbers of jokers in hands", type=int, nargs='+',
+                                choices=(0, 1, 2), default=[0, 1, 2])
+    compare_parser.add_argument("--seed", help="random seed", type=int, default=0)
+
+    bench_parser = sub_parsers.add_parser('bench', help="measure hands/sec of every evaluator")
+    bench_parser.add_argument("--hands", help="maximal number of hands for every evaluator", type=int,
+                              default=100000)
+    bench_parser.add_argument("--min-time", help="stop evaluating hands one by one after seconds", type=float,
+                              default=1.0)
+    bench_parser.add_argument("--distinct", help="draw hands from this number of distinct hands", type=int)
+    bench_parser.add_argument("--evaluator", help="evaluators to measure, all by default", nargs='+')
+    bench_parser.add_argument("--seed", help="random seed", type=int, default=0)
+
+    sub_parsers.add_parser('test', help="run tests")
+
+    args = args_parser.parse_args()
+
+    if args.command == 'enumerate':
+        start = time.perf_counter()
+        category_counts, value_count = count_categories(args.evaluator)
+        for category in sorted(CATEGORY_COUNTS, reverse=True):
+            print('{}: {}'.format(CATEGORY_NAMES[category], category_counts[category]))
+        print('{} hands, {} distinct values, {:.1f} sec'.format(
+            sum(category_counts.values()), value_count, time.perf_counter() - start))
+        errors = check_categories(category_counts, value_count)
+        for error in errors:
+            print('ERROR: ' + error)
+        if errors:
+            raise SystemExit(1)
+
+    elif args.command == 'compare':
+        failed = False
+        for jokers in args.jokers:
+            samples = args.wild_samples if jokers else args.samples
+            mismatches = compare_hands(samples, jokers, args.seed)
+            print('{} jokers: {} hands, {} mismatches'.format(
+                jokers, samples, sum(len(hands) for hands in mismatches.values())))
+            for name, hands in sorted(mismatches.items()):
+                failed = True
+                print('  {}: {} mismatches'.format(name, len(hands)))
+                for hand in hands[:MISMATCH_EXAMPLES]:
+                    print('    ' + ' '.join(hand))
+        if failed:
+            raise SystemExit(1)
+
+    elif args.command == 'bench':
+        for evaluator, count, hands_per_sec in bench(args.hands, args.min_time, args.seed, args.distinct,
+                                                     args.evaluator):
+            print('{:<26s} {:d} jokers: {:>10.0f} hands/sec ({} hands)'.format(
+                evaluator.name, evaluator.jokers, hands_per_sec, count))
+
+    elif args.command == 'test':
+        test_count_categories()
+        test_compare_hands()
+        test_bench()
+
+
+if __name__ == '__main__':
+    main()
@@ -28,43 +28,164 @@
 # -----------------
 
 import itertools
+import collections
+import functools
+import random
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+RANK_LIST = '2 3 4 5 6 7 8 9 T J Q K A'.split()
+RANK_PRIORITIES = {RANK_LIST[n]: n for n in range(0, len(RANK_LIST))}
+# сначала черные масти, потом красные: цвет масти s это s >> 1
+SUIT_LIST = 'C S H D'.split()
+SUIT_PRIORITIES = {SUIT_LIST[n]: n for n in range(0, len(SUIT_LIST))}
+
+# карта кодируется числом rank * 4 + suit от 0 до 51
+CARD_LIST = [r + s for r in RANK_LIST for s in SUIT_LIST]
+CARD_INDEX = {CARD_LIST[n]: n for n in range(0, len(CARD_LIST))}
+RANK_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41]
+CARD_BITS = [1 << (n >> 2) for n in range(0, len(CARD_LIST))]
+CARD_PRIMES = [RANK_PRIMES[n >> 2] for n in range(0, len(CARD_LIST))]
+CANONICAL_CACHE_SIZE = 1 << 16
+
+HIGH_CARD, PAIR, TWO_PAIR, THREE_OF_A_KIND, STRAIGHT, FLUSH, FULL_HOUSE, FOUR_OF_A_KIND, STRAIGHT_FLUSH = range(9)
+CATEGORY_SHIFT = 20
+KIND_CATEGORIES = {
+    (4, 1): FOUR_OF_A_KIND,
+    (3, 2): FULL_HOUSE,
+    (3, 1, 1): THREE_OF_A_KIND,
+    (2, 2, 1): TWO_PAIR,
+    (2, 1, 1, 1): PAIR,
+}
+# маски рангов стритов от старшего, последний - стрит от туза до пятерки
+STRAIGHT_MASKS = [(0x1F << (top - 4), top) for top in range(12, 3, -1)] + [(0x100F, 3)]
+
+
+def make_value(category, ranks):
+    """
+    Возвращает число, определяющее ранг 'руки': категория и значимые ранги
+    по 4 бита от старшего. Числа сравниваются так же, как кортежи hand_rank
+    """
+    value = category
+    for r in ranks:
+        value = value << 4 | r
+    return value << 4 * (5 - len(ranks))
+
+
+def straight_top(rank_mask):
+    """Возвращает старший ранг лучшего стрита из рангов маски или None"""
+    for mask, top in STRAIGHT_MASKS:
+        if rank_mask & mask == mask:
+            return top
+    return None
+
+
+def make_tables():
+    """
+    Таблицы значений рук из 5 карт: для флешей и для рук из 5 разных рангов
+    по маске рангов, для остальных рук по произведению простых чисел рангов
+    """
+    flush_values = [0] * (1 << len(RANK_LIST))
+    unique_values = [0] * (1 << len(RANK_LIST))
+    kind_values = {}
+    for ranks in itertools.combinations_with_replacement(range(len(RANK_LIST) - 1, -1, -1), 5):
+        counts = collections.Counter(ranks)
+        if len(counts) == 5:
+            rank_mask = sum(1 << r for r in ranks)
+            top = straight_top(rank_mask)
+            if top is None:
+                flush_values[rank_mask] = make_value(FLUSH, ranks)
+                unique_values[rank_mask] = make_value(HIGH_CARD, ranks)
+            else:
+                flush_values[rank_mask] = make_value(STRAIGHT_FLUSH, [top])
+                unique_values[rank_mask] = make_value(STRAIGHT, [top])
+        elif max(counts.values()) <= 4:
+            # ранги по убыванию количества, затем по убыванию ранга
+            groups = sorted(counts.items(), key=lambda x: (x[1], x[0]), reverse=True)
+            category = KIND_CATEGORIES[tuple(n for _, n in groups)]
+            product = 1
+            for r in ranks:
+                product *= RANK_PRIMES[r]
+            kind_values[product] = make_value(category, [r for r, _ in groups])
+    return flush_values, unique_values, kind_values
+
+
+FLUSH_VALUES, UNIQUE_VALUES, KIND_VALUES = make_tables()
+
+
+def evaluate5(a, b, c, d, e):
+    """Возвращает число, определяющее ранг 'руки' из 5 карт, заданных индексами"""
+    if not ((a ^ b) | (a ^ c) | (a ^ d) | (a ^ e)) & 3:
+        return FLUSH_VALUES[CARD_BITS[a] | CARD_BITS[b] | CARD_BITS[c] | CARD_BITS[d] | CARD_BITS[e]]
+    value = UNIQUE_VALUES[CARD_BITS[a] | CARD_BITS[b] | CARD_BITS[c] | CARD_BITS[d] | CARD_BITS[e]]
+    if value:
+        return value
+    return KIND_VALUES[CARD_PRIMES[a] * CARD_PRIMES[b] * CARD_PRIMES[c] * CARD_PRIMES[d] * CARD_PRIMES[e]]
+
+
+def value_to_rank(value):
+    """Переводит число, определяющее ранг 'руки', в кортеж hand_rank"""
+    category = value >> CATEGORY_SHIFT
+    r = [(value >> 4 * (4 - n)) & 15 for n in range(0, 5)]
+    if category == STRAIGHT_FLUSH or category == STRAIGHT:
+        return (category, r[0])
+    elif category == FOUR_OF_A_KIND or category == FULL_HOUSE:
+        return (category, r[0], r[1])
+    elif category == FLUSH or category == HIGH_CARD:
+        return (category, r)
+    elif category == THREE_OF_A_KIND:
+        return (category, r[0], sorted([r[0], r[0], r[0], r[1], r[2]], reverse=True))
+    elif category == TWO_PAIR:
+        return (category, r[:2], sorted([r[0], r[0], r[1], r[1], r[2]], reverse=True))
+    else:
+        return (category, r[0], sorted([r[0], r[0], r[1], r[2], r[3]], reverse=True))
 
 
 def hand_rank(hand):
     """Возвращает значение определяющее ранг 'руки'"""
     assert (len(hand) == 5)
+    return value_to_rank(evaluate5(*[CARD_INDEX[c] for c in hand]))
+
+
+def hand_rank_reference(hand):
+    """hand_rank без таблиц, для проверки"""
+    assert (len(hand) == 5)
     ranks = card_ranks(hand)
     if straight(ranks) and flush(hand):
         return (8, max(ranks))
-    elif kind(4, ranks):
+    elif kind(4, ranks) is not None:
         return (7, kind(4, ranks), kind(1, ranks))
-    elif kind(3, ranks) and kind(2, ranks):
+    elif kind(3, ranks) is not None and kind(2, ranks) is not None:
         return (6, kind(3, ranks), kind(2, ranks))
     elif flush(hand):
         return (5, ranks)
     elif straight(ranks):
         return (4, max(ranks))
-    elif kind(3, ranks):
+    elif kind(3, ranks) is not None:
         return (3, kind(3, ranks), ranks)
-    elif two_pair(ranks):
+    elif two_pair(ranks) is not None:
         return (2, two_pair(ranks), ranks)
-    elif kind(2, ranks):
+    elif kind(2, ranks) is not None:
         return (1, kind(2, ranks), ranks)
     else:
         return (0, ranks)
 
 
-RANK_LIST = '2 3 4 5 6 7 8 9 T J Q K A'.split()
-RANK_PRIORITIES = {RANK_LIST[n]: n for n in range(0, len(RANK_LIST))}
-
-
 def card_ranks(hand):
-    """Возвращает список рангов (его числовой эквивалент), отсортированный от большего к меньшему"""
+    """
+    Возвращает список рангов (его числовой эквивалент), отсортированный от большего к меньшему.
+    Туз в стрите от туза до пятерки считается младшей картой
+    """
     assert (len(hand) == 5)
-    return sorted(
-        map(lambda c: c[:1], hand),
-        key=lambda x: RANK_PRIORITIES[x],
+    ranks = sorted(
+        map(lambda c: RANK_PRIORITIES[c[:1]], hand),
         reverse=True)
+    return [3, 2, 1, 0, -1] if ranks == [12, 3, 2, 1, 0] else ranks
 
 
 def flush(hand):
@@ -86,8 +207,8 @@ def straight(ranks):
     s = None
     for r in ranks:
         if s is None:
-            s = RANK_PRIORITIES[r]
-        elif s - 1 == RANK_PRIORITIES[r]:
+            s = r
+        elif s - 1 == r:
             s = s - 1
         else:
             s = None
@@ -126,53 +247,455 @@ def two_pair(ranks):
     return pairs if len(pairs) == 2 else None
 
 
+def straight_ranks(top):
+    """Ранги стрита со старшим рангом top, туз в младшем стрите последний"""
+    return [top, top - 1, top - 2, top - 3, (top - 4) % len(RANK_LIST)]
+
+
+def evaluate_cards(cards):
+    """
+    Из 5-7 карт, заданных индексами, за один проход по маскам мастей и
+    группам рангов выбирает лучшие 5 карт. Возвращает число, определяющее
+    ранг 'руки', и индексы выбранных карт
+    """
+    cards = sorted(cards, reverse=True)
+    suit_masks = [0, 0, 0, 0]
+    for c in cards:
+        suit_masks[c & 3] |= CARD_BITS[c]
+
+    # в 7 картах флеш не совместим с каре и фулл-хаусом
+    for suit in range(0, 4):
+        mask = suit_masks[suit]
+        if POPCOUNTS[mask] >= 5:
+            top = STRAIGHT_TOPS[mask]
+            if top is not None:
+                return make_value(STRAIGHT_FLUSH, [top]), [r * 4 + suit for r in straight_ranks(top)]
+            best = [c for c in cards if c & 3 == suit][:5]
+            return make_value(FLUSH, [c >> 2 for c in best]), best
+
+    groups = []
+    for c in cards:
+        if groups and groups[-1][0] >> 2 == c >> 2:
+            groups[-1].append(c)
+        else:
+            groups.append([c])
+    # сортировка устойчива: группы одного размера остаются по убыванию ранга
+    groups.sort(key=len, reverse=True)
+    top = STRAIGHT_TOPS[suit_masks[0] | suit_masks[1] | suit_masks[2] | suit_masks[3]]
+
+    if len(groups[0]) == 4:
+        kicker = max(c for g in groups[1:] for c in g)
+        return make_value(FOUR_OF_A_KIND, [groups[0][0] >> 2, kicker >> 2]), groups[0] + [kicker]
+    elif len(groups[0]) == 3 and len(groups[1]) >= 2:
+        return make_value(FULL_HOUSE, [groups[0][0] >> 2, groups[1][0] >> 2]), groups[0] + groups[1][:2]
+    elif top is not None:
+        rank_cards = {c >> 2: c for c in cards}
+        return make_value(STRAIGHT, [top]), [rank_cards[r] for r in straight_ranks(top)]
+    elif len(groups[0]) == 3:
+        kickers = sorted((c for g in groups[1:] for c in g), reverse=True)[:2]
+        return make_value(THREE_OF_A_KIND, [groups[0][0] >> 2] + [c >> 2 for c in kickers]), groups[0] + kickers
+    elif len(groups[0]) == 2 and len(groups[1]) == 2:
+        kicker = max(c for g in groups[2:] for c in g)
+        return (make_value(TWO_PAIR, [groups[0][0] >> 2, groups[1][0] >> 2, kicker >> 2]),
+                groups[0] + groups[1] + [kicker])
+    elif len(groups[0]) == 2:
+        kickers = [g[0] for g in groups[1:4]]
+        return make_value(PAIR, [groups[0][0] >> 2] + [c >> 2 for c in kickers]), groups[0] + kickers
+    else:
+        return make_value(HIGH_CARD, [c >> 2 for c in cards[:5]]), cards[:5]
+
+
+POPCOUNTS = [bin(m).count('1') for m in range(0, 1 << len(RANK_LIST))]
+STRAIGHT_TOPS = [straight_top(m) for m in range(0, 1 << len(RANK_LIST))]
+
+
+def parse_hand(hand):
+    """Возвращает индексы карт 'руки', заданной строкой 'AS KD' или списком"""
+    if isinstance(hand, str):
+        hand = hand.split()
+    return [CARD_INDEX[c] for c in hand]
+
+
+def format_hand(cards):
+    """Возвращает список карт по индексам"""
+    return [CARD_LIST[c] for c in cards]
+
+
+def hand_mask(cards):
+    """Возвращает 52-битную маску карт, заданных индексами"""
+    mask = 0
+    for c in cards:
+        mask |= 1 << c
+    return mask
+
+
+def mask_cards(mask):
+    """Возвращает индексы карт маски по возрастанию"""
+    return [c for c in range(0, len(CARD_LIST)) if mask >> c & 1]
+
+
+def canonical_hand(cards, jokers=()):
+    """
+    Возвращает ключ 'руки', одинаковый для рук, отличающихся только
+    перестановкой мастей: маски рангов мастей по убыванию и цвета джокеров,
+    и масти руки в порядке ключа. Джокер заменяет карту только своего
+    цвета, поэтому с джокерами масти переставляются только внутри цвета
+    """
+    suit_masks = [0, 0, 0, 0]
+    for c in cards:
+        suit_masks[c & 3] |= CARD_BITS[c]
+    if jokers:
+        suits = (sorted((0, 1), key=suit_masks.__getitem__, reverse=True) +
+                 sorted((2, 3), key=suit_masks.__getitem__, reverse=True))
+    else:
+        suits = sorted(range(0, 4), key=suit_masks.__getitem__, reverse=True)
+    key = 0
+    for suit in suits:
+        key = key << len(RANK_LIST) | suit_masks[suit]
+    return (key, tuple(sorted(jokers))), suits
+
+
+@functools.lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def evaluate_canonical(key):
+    masks, jokers = key
+    cards = [r * 4 + n for n in range(0, 4) for r in range(0, len(RANK_LIST))
+             if masks >> len(RANK_LIST) * (3 - n) >> r & 1]
+    value, best = evaluate_wild_cards(cards, list(jokers))
+    return value, tuple(best)
+
+
+def evaluate_cards_cached(cards, jokers=()):
+    """
+    evaluate_wild_cards с кэшем по ключу canonical_hand. Выигрыш есть, когда
+    оценка дороже ключа: для рук с джокерами и повторяющихся раздач
+    """
+    key, suits = canonical_hand(cards, jokers)
+    value, best = evaluate_canonical(key)
+    # масть n в ключе это масть suits[n] руки
+    return value, [(c >> 2) * 4 + suits[c & 3] for c in best]
+
+
+def best_hand_cached(hand):
+    """best_hand с кэшем результатов для рук, одинаковых с точностью до перестановки мастей"""
+    best = set(evaluate_cards_cached([CARD_INDEX[c] for c in hand])[1])
+    return tuple(c for c in hand if CARD_INDEX[c] in best)
+
+
+def best_wild_hand_cached(hand):
+    """best_wild_hand с кэшем результатов для рук, одинаковых с точностью до перестановки мастей"""
+    cards = [CARD_INDEX[c] for c in hand if c not in JOKER_COLOURS]
+    jokers = [JOKER_COLOURS[c] for c in hand if c in JOKER_COLOURS]
+    best = evaluate_cards_cached(cards, jokers)[1]
+    return tuple([c for c in hand if c not in JOKER_COLOURS and CARD_INDEX[c] in best] +
+                 [CARD_LIST[c] for c in best if c not in cards])
+
+
 def best_hand(hand):
     """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт """
-    rank = None
-    best = None
-    for h in itertools.combinations(hand, 5):
-        r = hand_rank(h)
-        if r is not None and (rank is None or rank < r[0]):
-            rank = r[0]
-            best = h
-    return best
+    best = set(evaluate_cards([CARD_INDEX[c] for c in hand])[1])
+    return tuple(c for c in hand if CARD_INDEX[c] in best)
+
+
+def best_hand_reference(hand):
+    """best_hand перебором всех 5 карт из 7, для проверки"""
+    return max(itertools.combinations(hand, 5), key=hand_rank_reference)
 
 
 BLACK_JOKER = [x[0] + x[1] for x in itertools.product(RANK_LIST, ['C', 'S'])]
 RED_JOKER = [x[0] + x[1] for x in itertools.product(RANK_LIST, ['D', 'H'])]
 
 
+JOKER_COLOURS = {'?B': 0, '?R': 1}
+
+
+def joker_card(rank, colour, used):
+    """Возвращает карту ранга rank масти цвета colour, которой нет в used, или None"""
+    for suit in (colour * 2, colour * 2 + 1):
+        c = rank * 4 + suit
+        if c not in used:
+            return c
+    return None
+
+
+def assign_jokers(ranks, jokers, used, chosen):
+    """Варианты заменить джокерами карты рангов ranks: выбранные карты и оставшиеся джокеры"""
+    if not ranks:
+        yield chosen, jokers
+        return
+    for n in range(0, len(jokers)):
+        if jokers[n] in jokers[:n]:
+            continue
+        c = joker_card(ranks[0], jokers[n], used)
+        if c is not None:
+            yield from assign_jokers(ranks[1:], jokers[:n] + jokers[n + 1:], used | {c}, chosen + [c])
+
+
+def joker_kicker(colour, ranks, used):
+    """Возвращает старшую карту цвета colour, которой нет в used, с рангом не из ranks"""
+    for r in range(len(RANK_LIST) - 1, -1, -1):
+        if r not in ranks:
+            c = joker_card(r, colour, used)
+            if c is not None:
+                return c
+    return None
+
+
+def add_kickers(chosen, count, cards, jokers, used):
+    """
+    Добавляет к chosen count старших карт разных рангов, не совпадающих с
+    рангами chosen: из карт руки или из оставшихся джокеров
+    """
+    chosen = list(chosen)
+    ranks = {c >> 2 for c in chosen}
+    cards = [c for c in cards if c not in chosen]
+    jokers = list(jokers)
+    used = set(used)
+    for _ in range(0, count):
+        best = next((c for c in cards if c >> 2 not in ranks), None)
+        best_joker = None
+        for n in range(0, len(jokers)):
+            c = joker_kicker(jokers[n], ranks, used)
+            if c is not None and (best is None or c >> 2 > best >> 2):
+                best = c
+                best_joker = n
+        if best is None:
+            return None
+        if best_joker is not None:
+            del jokers[best_joker]
+            used.add(best)
+        chosen.append(best)
+        ranks.add(best >> 2)
+    return chosen
+
+
+def best_kind(cards, rank_cards, jokers, candidates, kicker_count):
+    """
+    Первый из наборов (rank, count), отсортированных по убыванию, который
+    можно собрать из карт руки и джокеров, с лучшими дополнительными картами
+    """
+    have = set(cards)
+    for needs in candidates:
+        chosen = []
+        deficits = []
+        for rank, count in needs:
+            chosen.extend(rank_cards[rank][:count])
+            deficits.extend([rank] * (count - len(rank_cards[rank][:count])))
+        if len(deficits) > len(jokers):
+            continue
+        best = None
+        for filled, free_jokers in assign_jokers(deficits, jokers, have, chosen):
+            hand = add_kickers(filled, kicker_count, cards, free_jokers, have | set(filled))
+            if hand is not None:
+                value = evaluate5(*hand)
+                if best is None or best[0] < value:
+                    best = (value, hand)
+        if best is not None:
+            return best
+    return None
+
+
+def best_flush(cards, jokers):
+    """Лучший флеш, где джокеры заменяют старшие недостающие карты масти их цвета"""
+    best = None
+    for suit in range(0, 4):
+        suited = [c for c in cards if c & 3 == suit]
+        suit_jokers = [j for j in jokers if j == suit >> 1]
+        if len(suited) + len(suit_jokers) < 5:
+            continue
+        missing = [r * 4 + suit for r in range(len(RANK_LIST) - 1, -1, -1) if r * 4 + suit not in suited]
+        hand = sorted(suited + missing[:len(suit_jokers)], reverse=True)[:5]
+        value = evaluate5(*hand)
+        if best is None or best[0] < value:
+            best = (value, hand)
+    return best
+
+
+def evaluate_wild_cards(cards, jokers):
+    """
+    Из карт, заданных индексами, и джокеров заданных цветов выбирает лучшие
+    5 карт. Категории перебираются от старшей к младшей, для каждой
+    по маскам рангов проверяется, могут ли джокеры дополнить карты руки до нее
+    """
+    if not jokers:
+        return evaluate_cards(cards)
+    cards = sorted(cards, reverse=True)
+    rank_cards = [[] for _ in RANK_LIST]
+    suit_masks = [0, 0, 0, 0]
+    for c in cards:
+        rank_cards[c >> 2].append(c)
+        suit_masks[c & 3] |= CARD_BITS[c]
+    rank_mask = suit_masks[0] | suit_masks[1] | suit_masks[2] | suit_masks[3]
+    colour_counts = [jokers.count(0), jokers.count(1)]
+
+    for mask, top in STRAIGHT_MASKS:
+        for suit in range(0, 4):
+            if POPCOUNTS[mask & ~suit_masks[suit]] <= colour_counts[suit >> 1]:
+                hand = [r * 4 + suit for r in straight_ranks(top)]
+                return evaluate5(*hand), hand
+
+    # ранги, которые можно набрать count раз, если заменить джокерами
+    # недостающие карты и еще extra карт других рангов
+    def kinds(count, extra=0):
+        return [r for r in range(len(RANK_LIST) - 1, -1, -1) if len(rank_cards[r]) + len(jokers) >= count + extra]
+
+    def deficit(rank, count):
+        return max(0, count - len(rank_cards[rank]))
+
+    best = (best_kind(cards, rank_cards, jokers, ([(r, 4)] for r in kinds(4)), 1) or
+            best_kind(cards, rank_cards, jokers,
+                      ([(t, 3), (p, 2)] for t in kinds(3) for p in kinds(2, deficit(t, 3)) if p != t), 0) or
+            best_flush(cards, jokers))
+    if best is not None:
+        return best
+
+    for mask, top in STRAIGHT_MASKS:
+        # недостающих рангов стрита нет в руке, джокер любого цвета их заменит
+        if POPCOUNTS[mask & ~rank_mask] <= len(jokers):
+            return best_kind(cards, rank_cards, jokers, [[(r, 1) for r in straight_ranks(top)]], 0)
+
+    return (best_kind(cards, rank_cards, jokers, ([(r, 3)] for r in kinds(3)), 2) or
+            best_kind(cards, rank_cards, jokers,
+                      ([(p, 2), (q, 2)] for p in kinds(2) for q in kinds(2, deficit(p, 2)) if q < p), 1) or
+            best_kind(cards, rank_cards, jokers, ([(r, 2)] for r in kinds(2)), 3) or
+            best_kind(cards, rank_cards, jokers, [[]], 5))
+
+
 def best_wild_hand(hand):
     """best_hand но с джокерами"""
+    cards = [CARD_INDEX[c] for c in hand if c not in JOKER_COLOURS]
+    jokers = [JOKER_COLOURS[c] for c in hand if c in JOKER_COLOURS]
+    best = evaluate_wild_cards(cards, jokers)[1]
+    return tuple([c for c in hand if c not in JOKER_COLOURS and CARD_INDEX[c] in best] +
+                 [CARD_LIST[c] for c in best if c not in cards])
+
+
+def best_wild_hand_reference(hand):
+    """
+    best_wild_hand перебором всех 5 карт из 7 и всех замен джокеров в них
+    без таблиц, для проверки. Джокер не заменяет карту, которая есть в руке
+    """
     rank = None
     best = None
+    for combination in itertools.combinations(hand, 5):
+        cards = [c for c in combination if c not in JOKER_COLOURS]
+        jokers = [BLACK_JOKER if c == '?B' else RED_JOKER for c in combination if c in JOKER_COLOURS]
+        for joker_cards in itertools.product(*jokers):
+            if len(set(joker_cards)) < len(joker_cards) or any(c in hand for c in joker_cards):
+                continue
+            h = cards + list(joker_cards)
+            r = hand_rank_reference(h)
+            if rank is None or rank < r:
+                rank = r
+                best = tuple(h)
+    return best
 
-    cards = []
-    jokers = []
 
-    for c in hand:
-        if c == '?B':
-            jokers.append(BLACK_JOKER)
-        elif c == '?R':
-            jokers.append(RED_JOKER)
-        else:
-            cards.append(c)
-    set_cards = {x for x in cards}
-    for joker_hand in itertools.product(*jokers):
-        skip = False
-        for j in joker_hand:
-            if j in set_cards:
-                skip = True
-                break
-        if skip:
+# джокеры в массиве карт для best_hand_batch
+JOKER_CODES = {'?B': len(CARD_LIST), '?R': len(CARD_LIST) + 1}
+BATCH_SIZE = 1 << 16
+
+
+def make_batch_tables():
+    """
+    Таблицы для best_hand_batch: значения рук из 5 карт по отсортированным
+    по возрастанию рангам r0..r4 с ключом r0 + 13 * r1 + ... + 13 ** 4 * r4,
+    отдельно для флешей
+    """
+    kind_values = numpy.zeros(len(RANK_LIST) ** 5, dtype=numpy.int32)
+    flush_values = numpy.zeros(len(RANK_LIST) ** 5, dtype=numpy.int32)
+    for ranks in itertools.combinations_with_replacement(range(0, len(RANK_LIST)), 5):
+        if ranks[0] == ranks[4]:
             continue
-        real_hand = itertools.chain(cards, joker_hand)
-        for h in itertools.combinations(real_hand, 5):
-            r = hand_rank(h)
-            if r is not None and (rank is None or rank < r[0]):
-                rank = r[0]
-                best = h
-    return best
+        key = sum(ranks[n] * len(RANK_LIST) ** n for n in range(0, 5))
+        # у первой и последней карты одна масть, но ранги у них разные
+        kind_values[key] = evaluate5(*[ranks[n] * 4 + n % 4 for n in range(0, 5)])
+        if len(set(ranks)) == 5:
+            flush_values[key] = evaluate5(*[r * 4 for r in ranks])
+    return {
+        'combinations': numpy.array(list(itertools.combinations(range(0, 7), 5)), dtype=numpy.intp),
+        'kind_values': kind_values,
+        'flush_values': flush_values,
+    }
+
+
+BATCH_TABLES = make_batch_tables() if numpy is not None else None
+
+
+def encode_hands(hands):
+    """Переводит список 'рук' из 7 карт в массив numpy (N, 7) индексов карт, джокеры кодируются JOKER_CODES"""
+    codes = dict(CARD_INDEX, **JOKER_CODES)
+    return numpy.array([[codes[c] for c in hand] for hand in hands], dtype=numpy.int64).reshape(-1, 7)
+
+
+def best_hand_batch_part(cards):
+    combinations = BATCH_TABLES['combinations']
+    # в сочетаниях отсортированных карт ранги идут по возрастанию
+    order = numpy.argsort(cards, axis=1)
+    cards = numpy.take_along_axis(cards, order, axis=1).astype(numpy.int16)
+    ranks = cards >> 2
+    suits = cards & 3
+    keys = ranks[:, combinations[:, 0]].astype(numpy.int32)
+    for n in range(1, 5):
+        keys += ranks[:, combinations[:, n]].astype(numpy.int32) * len(RANK_LIST) ** n
+    values = BATCH_TABLES['kind_values'][keys]
+
+    # флеш возможен только если 5 карт строки одной масти
+    suit_counts = (suits[:, :, numpy.newaxis] == numpy.arange(0, 4)).sum(axis=1)
+    flush_rows = numpy.flatnonzero(suit_counts.max(axis=1) >= 5)
+    if len(flush_rows) > 0:
+        flush_suits = suits[flush_rows][:, combinations]
+        is_flush = (flush_suits == flush_suits[:, :, :1]).all(axis=2)
+        values[flush_rows] = numpy.where(
+            is_flush, BATCH_TABLES['flush_values'][keys[flush_rows]], values[flush_rows])
+
+    best = values.argmax(axis=1)
+    indices = numpy.sort(numpy.take_along_axis(order, combinations[best], axis=1), axis=1)
+    return values[numpy.arange(len(cards)), best], indices
+
+
+def best_hand_batch(cards):
+    """
+    best_hand для массива numpy (N, 7) индексов карт: все 21 сочетание из 5
+    карт оцениваются по таблицам операциями над массивами. Возвращает
+    массив (N,) чисел, определяющих ранг лучшей 'руки', и массив (N, 5)
+    номеров ее карт в строке. Строки с джокерами оцениваются по одной
+    """
+    if numpy is None:
+        raise ImportError('numpy is required for best_hand_batch')
+    cards = numpy.asarray(cards, dtype=numpy.int64).reshape(-1, 7)
+    values = numpy.zeros(len(cards), dtype=numpy.int64)
+    indices = numpy.zeros((len(cards), 5), dtype=numpy.intp)
+    wild = (cards >= len(CARD_LIST)).any(axis=1)
+    plain_rows = numpy.flatnonzero(~wild)
+    for start in range(0, len(plain_rows), BATCH_SIZE):
+        rows = plain_rows[start:start + BATCH_SIZE]
+        values[rows], indices[rows] = best_hand_batch_part(cards[rows])
+    for row in numpy.flatnonzero(wild).tolist():
+        hand = cards[row].tolist()
+        real = [c for c in hand if c < len(CARD_LIST)]
+        jokers = [c - len(CARD_LIST) for c in hand if c >= len(CARD_LIST)]
+        values[row], best = evaluate_wild_cards(real, jokers)
+        # карты, которыми заменены джокеры, занимают места джокеров
+        joker_positions = iter(n for n in range(0, 7) if hand[n] >= len(CARD_LIST))
+        indices[row] = sorted(hand.index(c) if c in real else next(joker_positions) for c in best)
+    return values, indices
+
+
+def test_hand_rank():
+    print("test_hand_rank...")
+    assert (hand_rank("6C 7C 8C 9C TC".split()) == (8, 8))
+    assert (hand_rank("AD 2C 3H 4S 5D".split()) == (4, 3))
+    assert (hand_rank("TD TC TH 7C 7D".split()) == (6, 8, 5))
+    assert (hand_rank("JD TC TH 7C 7D".split()) == (2, [8, 5], [9, 8, 8, 5, 5]))
+    rnd = random.Random(0)
+    hands = [rnd.sample(CARD_LIST, 5) for _ in range(10000)]
+    ranks = [hand_rank(h) for h in hands]
+    for h, r in zip(hands, ranks):
+        assert (r == hand_rank_reference(h)), h
+    values = [evaluate5(*[CARD_INDEX[c] for c in h]) for h in hands]
+    for n in range(1, len(hands)):
+        assert ((values[n - 1] < values[n]) == (ranks[n - 1] < ranks[n])), (hands[n - 1], hands[n])
+    print('OK')
 
 
 def test_best_hand():
@@ -180,32 +703,93 @@ def test_best_hand():
     assert (sorted(best_hand(
         "6C 7C 8C 9C TC 5C JS".split())) == ['6C', '7C', '8C', '9C', 'TC'])
     assert (sorted(best_hand(
-        "TD TC TH 7C 7D 8C 8S".split())) == ['7C', '7D', 'TC', 'TD', 'TH'])
-    # другой вариант 3+2 встречается раньше
-    # assert (sorted(best_hand("TD TC TH 7C 7D 8C 8S".split()))
-    #         == ['8C', '8S', 'TC', 'TD', 'TH'])
+        "TD TC TH 7C 7D 8C 8S".split())) == ['8C', '8S', 'TC', 'TD', 'TH'])
     assert (sorted(best_hand(
         "JD TC TH 7C 7D 7S 7H".split())) == ['7C', '7D', '7H', '7S', 'JD'])
+    assert (sorted(best_hand(
+        "AD 2C 3H 4S 5D KC KS".split())) == ['2C', '3H', '4S', '5D', 'AD'])
+    rnd = random.Random(1)
+    for _ in range(2000):
+        hand = rnd.sample(CARD_LIST, 7)
+        assert (hand_rank(best_hand(hand)) == hand_rank_reference(best_hand_reference(hand))), hand
     print('OK')
 
 
 def test_best_wild_hand():
     print("test_best_wild_hand...")
     assert (sorted(best_wild_hand(
-        "6C 7C 8C 9C TC 5C ?B".split())) == ['6C', '7C', '8C', '9C', 'TC'])
-    # другой вариант флеш-страйка встречается раньше
-    # assert (sorted(best_wild_hand("6C 7C 8C 9C TC 5C ?B".split()))
-    #         == ['7C', '8C', '9C', 'JC', 'TC'])
+        "6C 7C 8C 9C TC 5C ?B".split())) == ['7C', '8C', '9C', 'JC', 'TC'])
     assert (sorted(best_wild_hand(
-        "TD TC 5H 5C 7C ?R ?B".split())) == ['5C', '5D', '5H', '5S', 'TD'])
-    # другой вариант 4+1 встречается раньше
-    # assert (sorted(best_wild_hand("TD TC 5H 5C 7C ?R ?B".split()))
-    #         == ['7C', 'TC', 'TD', 'TH', 'TS'])
+        "TD TC 5H 5C 7C ?R ?B".split())) == ['7C', 'TC', 'TD', 'TH', 'TS'])
     assert (sorted(best_wild_hand(
         "JD TC TH 7C 7D 7S 7H".split())) == ['7C', '7D', '7H', '7S', 'JD'])
+    rnd = random.Random(2)
+    for n in range(0, 300):
+        hand = rnd.sample(CARD_LIST, 7 - n % 3) + [['?B', '?R'][n % 2], '?B', '?R'][:n % 3]
+        assert (hand_rank(best_wild_hand(hand)) == hand_rank(best_wild_hand_reference(hand))), hand
+    print('OK')
+
+
+def test_best_hand_batch():
+    print("test_best_hand_batch...")
+    if numpy is None:
+        print('SKIP: numpy is not installed')
+        return
+    rnd = random.Random(3)
+    hands = [rnd.sample(CARD_LIST, 7) for _ in range(0, 2000)]
+    hands += [rnd.sample(CARD_LIST, 6) + ['?B'] for _ in range(0, 20)]
+    hands += [rnd.sample(CARD_LIST, 5) + ['?R', '?B'] for _ in range(0, 20)]
+    values, indices = best_hand_batch(encode_hands(hands))
+    for hand, value, hand_indices in zip(hands, values.tolist(), indices.tolist()):
+        assert (hand_rank(best_wild_hand(hand)) == value_to_rank(value)), hand
+        assert (len(set(hand_indices)) == 5), hand
+        if not any(hand[n] in JOKER_COLOURS for n in hand_indices):
+            assert (evaluate5(*[CARD_INDEX[hand[n]] for n in hand_indices]) == value), hand
+
+    cards = encode_hands([rnd.sample(CARD_LIST, 7) for _ in range(0, 100000)])
+    start = time.perf_counter()
+    best_hand_batch(cards)
+    print('{:.0f} hands/sec'.format(len(cards) / (time.perf_counter() - start)))
+    print('OK')
+
+
+def test_canonical_hand():
+    print("test_canonical_hand...")
+    assert (format_hand(parse_hand("AS TD 2C")) == ['AS', 'TD', '2C'])
+    assert (mask_cards(hand_mask(parse_hand("AS TD 2C"))) == sorted(parse_hand("AS TD 2C")))
+    rnd = random.Random(4)
+    evaluate_canonical.cache_clear()
+    for _ in range(0, 1000):
+        cards = rnd.sample(range(0, len(CARD_LIST)), 7)
+        permutation = rnd.sample(range(0, 4), 4)
+        permuted = [(c >> 2) * 4 + permutation[c & 3] for c in cards]
+        assert (canonical_hand(cards)[0] == canonical_hand(permuted)[0])
+        assert (evaluate_cards_cached(cards)[0] == evaluate_cards(cards)[0])
+        # рука с переставленными мастями берется из кэша
+        value, best = evaluate_cards_cached(permuted)
+        assert (value == evaluate_cards(permuted)[0] and set(best) <= set(permuted)), permuted
+        assert (evaluate5(*best) == value), permuted
+    assert (evaluate_canonical.cache_info().hits >= 1000)
+    for _ in range(0, 300):
+        cards = rnd.sample(range(0, len(CARD_LIST)), 5)
+        jokers = rnd.choice([[0], [1], [0, 1]])
+        # перестановка внутри цвета
+        permutation = rnd.sample((0, 1), 2) + rnd.sample((2, 3), 2)
+        permuted = [(c >> 2) * 4 + permutation[c & 3] for c in cards]
+        assert (canonical_hand(cards, jokers)[0] == canonical_hand(permuted, jokers)[0])
+        value, best = evaluate_cards_cached(permuted, jokers)
+        assert (value == evaluate_wild_cards(permuted, jokers)[0] and evaluate5(*best) == value), permuted
+        assert (len(set(best) - set(permuted)) <= len(jokers)), permuted
+    hand = "TD TC TH 7C 7D 8C 8S".split()
+    assert (best_hand_cached(hand) == best_hand(hand))
+    hand = "TD TC 5H 5C 7C ?R ?B".split()
+    assert (sorted(best_wild_hand_cached(hand)) == sorted(best_wild_hand(hand)))
     print('OK')
 
 
 if __name__ == '__main__':
+    test_hand_rank()
     test_best_hand()
     test_best_wild_hand()
+    test_best_hand_batch()
+    test_canonical_hand()